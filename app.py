@@ -1,20 +1,45 @@
-from flask import Flask, request, jsonify, send_file
-import os, json, base64, traceback, tempfile
+from flask import Flask, request, jsonify, send_file, g, Response, stream_with_context
+from werkzeug.exceptions import HTTPException
+import os, sys, json, base64, traceback, tempfile, shutil
 from io import BytesIO
 
 import firebase_admin
-from firebase_admin import credentials, storage, db as rtdb, firestore
+from firebase_admin import credentials, storage, db as rtdb, firestore, messaging
 
+from google.api_core.exceptions import NotFound, FailedPrecondition, AlreadyExists
 from openai import OpenAI
+import requests
 from PIL import Image
 from datetime import datetime
 
 from werkzeug.security import generate_password_hash, check_password_hash
+
+import imageops
+from bucketindex import BucketIndex
+from batching import plan_batch
+from pagination import (
+    PAGE_SIZE_MAX, encode_cursor, decode_cursor, parse_page_size, parse_fields, page_query
+)
 #-------------------------------------
 import qrcode
 import io
 import uuid
 import time
+import bisect
+import hashlib
+import functools
+import threading
+import queue
+import atexit
+import logging
+import logging.handlers
+from collections import OrderedDict
+from contextlib import contextmanager
+import multiprocessing
+import urllib.parse
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
  
 INSTALL_URL = "https://jai.app/install"
 
@@ -47,6 +72,1204 @@ bucket = storage.bucket()
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 client = OpenAI(api_key=OPENAI_API_KEY)
 
+# ---------------- Endpoint metrics -------------------
+# จำนวน RPC ของ Firestore และเวลาต่อ request แยกตาม endpoint → ดูที่ /endpoint_stats
+_endpoint_stats = {}
+_endpoint_stats_lock = threading.Lock()
+
+
+def record_endpoint(name, rpcs, elapsed_ms, reads=0, writes=0, rpc_ms=0.0):
+    with _endpoint_stats_lock:
+        stats = _endpoint_stats.setdefault(name, {
+            "count": 0, "rpcs": 0, "reads": 0, "writes": 0,
+            "rpc_ms": 0.0, "total_ms": 0.0, "max_ms": 0.0
+        })
+        stats["count"] += 1
+        stats["rpcs"] += rpcs
+        stats["reads"] += reads
+        stats["writes"] += writes
+        stats["rpc_ms"] += rpc_ms
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+
+
+def endpoint_stats():
+    with _endpoint_stats_lock:
+        result = {}
+        for name, stats in _endpoint_stats.items():
+            result[name] = {
+                **stats,
+                "avg_rpcs": round(stats["rpcs"] / stats["count"], 2),
+                "avg_ms": round(stats["total_ms"] / stats["count"], 2)
+            }
+        return result
+
+
+@app.route("/endpoint_stats", methods=["GET"])
+def get_endpoint_stats():
+    return jsonify(endpoint_stats())
+
+# ---------------- Request-scoped document loader -------------------
+# ใน 1 request อ่านเอกสารเดิมซ้ำได้โดยไม่ยิง Firestore ใหม่ และอ่านหลายเอกสารรวมเป็น get_all ครั้งเดียว
+# นับ reads / writes / RPC / เวลา RPC ของ request นั้น → ต่อท้าย Server-Timing และ /endpoint_stats
+class DocLoader:
+    def __init__(self):
+        self.docs = {}   # (path, field_paths) → DocumentSnapshot
+        self.rpcs = 0
+        self.reads = 0
+        self.writes = 0
+        self.rpc_ms = 0.0
+
+    def _cached(self, ref, field_paths):
+        # เอกสารเต็มใช้แทน projection ได้เสมอ
+        return self.docs.get((ref.path, None)) or self.docs.get((ref.path, field_paths))
+
+    def get_many(self, refs, field_paths=None):
+        field_paths = tuple(field_paths) if field_paths else None
+
+        missing = {}
+        for ref in refs:
+            if self._cached(ref, field_paths) is None:
+                missing[ref.path] = ref
+
+        if missing:
+            with self.rpc(reads=len(missing)):
+                for doc in db.get_all(
+                    list(missing.values()),
+                    field_paths=list(field_paths) if field_paths else None
+                ):
+                    self.docs[(doc.reference.path, field_paths)] = doc
+
+        return [self._cached(ref, field_paths) for ref in refs]
+
+    def get(self, ref, field_paths=None):
+        return self.get_many([ref], field_paths)[0]
+
+    def forget(self, *refs):
+        # เขียนทับแล้ว → ครั้งหน้าอ่านใหม่
+        for ref in refs:
+            for key in [k for k in self.docs if k[0] == ref.path]:
+                del self.docs[key]
+
+    @contextmanager
+    def rpc(self, reads=0, writes=0, rpcs=1):
+        # with request_docs().rpc(writes=2): ref.update(...)
+        # จำนวน reads ของ query รู้ทีหลัง → call["reads"] = len(docs)
+        # transaction: rpc(rpcs=0) จับแค่เวลา, ฟังก์ชันใน transaction นับ RPC / reads / writes เอง
+        call = {"reads": reads, "writes": writes}
+        started = time.perf_counter()
+        try:
+            yield call
+        finally:
+            self.note(rpcs, call["reads"], call["writes"], (time.perf_counter() - started) * 1000)
+
+    def note(self, rpcs=0, reads=0, writes=0, elapsed_ms=0.0):
+        self.rpcs += rpcs
+        self.reads += reads
+        self.writes += writes
+        self.rpc_ms += elapsed_ms
+
+    def stats(self):
+        return {
+            "rpcs": self.rpcs,
+            "reads": self.reads,
+            "writes": self.writes,
+            "rpc_ms": round(self.rpc_ms, 2)
+        }
+
+
+def request_docs():
+    if "doc_loader" not in g:
+        g.doc_loader = DocLoader()
+    return g.doc_loader
+
+
+def counted_transaction(fn):
+    # @firestore.transactional ที่นับ begin + commit ลง loader (argument สุดท้าย) ทุกรอบ
+    # transaction ถูก retry → fn ทำใหม่ทั้งหมด → read / write ที่ fn นับเองก็นับใหม่ด้วย
+    @functools.wraps(fn)
+    def attempt(transaction, *args):
+        args[-1].note(rpcs=2)
+        return fn(transaction, *args)
+
+    return firestore.transactional(attempt)
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def _report_request_docs(response):
+    loader = g.get("doc_loader")
+    if loader is not None and loader.rpcs:
+        elapsed_ms = (time.perf_counter() - g.request_started) * 1000
+        record_endpoint(
+            request.endpoint, loader.rpcs, elapsed_ms,
+            loader.reads, loader.writes, loader.rpc_ms
+        )
+        response.headers["Server-Timing"] = (
+            f'firestore;dur={loader.rpc_ms:.1f};'
+            f'desc="{loader.rpcs} rpc, {loader.reads} reads, {loader.writes} writes"'
+        )
+    return response
+
+# ---------------- Background tasks -------------------
+# งานที่ client ไม่ต้องรอ (FCM, idempotency, log) → ทำหลังตอบ response
+# thread (daemon) จำนวนจำกัด + คิวจำกัด: คิวเต็ม / กำลังปิด worker → ทำใน request เลย (ไม่ทิ้งงาน)
+# งานที่ส่งมาต้อง idempotent ถ้าให้ retry
+BG_TASK_THREADS = int(os.environ.get("BG_TASK_THREADS", "4"))
+BG_TASK_QUEUE = int(os.environ.get("BG_TASK_QUEUE", "1000"))
+BG_TASK_BACKOFF = float(os.environ.get("BG_TASK_BACKOFF", "0.5"))
+# gunicorn graceful_timeout (default 30s) ต้องมากกว่านี้
+BG_DRAIN_TIMEOUT = float(os.environ.get("BG_DRAIN_TIMEOUT", "20"))
+
+_bg_queue = queue.Queue(BG_TASK_QUEUE)
+_bg_lock = threading.Lock()
+_bg_idle = threading.Condition(_bg_lock)
+_bg_threads = []
+_bg_pending = 0   # อยู่ในคิว + กำลังทำ
+_bg_accepting = True
+_bg_stats = {
+    "submitted": 0, "inline": 0, "completed": 0, "failed": 0,
+    "retried": 0, "running": 0, "max_depth": 0
+}
+_bg_stats_by_name = {}
+
+
+def _bg_count(name, outcome):
+    with _bg_lock:
+        _bg_stats[outcome] += 1
+        per_name = _bg_stats_by_name.setdefault(name, {"completed": 0, "failed": 0, "retried": 0})
+        per_name[outcome] += 1
+
+
+def _run_task(task):
+    name, fn, args, kwargs, retries = task
+    for attempt in range(retries + 1):
+        try:
+            fn(*args, **kwargs)
+            _bg_count(name, "completed")
+            return
+        except Exception:
+            if attempt == retries:
+                log(f"🔥 ERROR background task {name}:", traceback.format_exc())
+                _bg_count(name, "failed")
+                return
+            _bg_count(name, "retried")
+            time.sleep(BG_TASK_BACKOFF * 2 ** attempt)
+
+
+def _bg_worker():
+    global _bg_pending
+    while True:
+        task = _bg_queue.get()
+        with _bg_lock:
+            _bg_stats["running"] += 1
+        try:
+            _run_task(task)
+        finally:
+            with _bg_idle:
+                _bg_stats["running"] -= 1
+                _bg_pending -= 1
+                if not _bg_pending:
+                    _bg_idle.notify_all()
+
+
+def run_in_background(name, fn, *args, retries=0, **kwargs):
+    # คืน True ถ้าเข้าคิว, False ถ้าทำไปแล้วใน thread นี้
+    global _bg_pending
+    task = (name, fn, args, kwargs, retries)
+
+    with _bg_lock:
+        # เริ่ม thread ตอนใช้ครั้งแรก (หลัง gunicorn fork)
+        if not _bg_threads:
+            for n in range(BG_TASK_THREADS):
+                thread = threading.Thread(target=_bg_worker, name=f"bg_task_{n}", daemon=True)
+                thread.start()
+                _bg_threads.append(thread)
+
+        if _bg_accepting:
+            try:
+                _bg_queue.put_nowait(task)
+                _bg_pending += 1
+                _bg_stats["submitted"] += 1
+                _bg_stats["max_depth"] = max(_bg_stats["max_depth"], _bg_queue.qsize())
+                return True
+            except queue.Full:
+                pass
+
+        _bg_stats["inline"] += 1
+
+    _run_task(task)
+    return False
+
+
+def drain_background(timeout=BG_DRAIN_TIMEOUT):
+    # worker ถูกสั่งปิด (gunicorn SIGTERM → sys.exit → atexit) → รองานที่ค้างให้เสร็จก่อน
+    # ไม่ติดตั้ง signal handler เอง (ชนกับของ gunicorn)
+    global _bg_accepting
+    deadline = time.monotonic() + timeout
+
+    with _bg_idle:
+        _bg_accepting = False
+        while _bg_pending and time.monotonic() < deadline:
+            _bg_idle.wait(deadline - time.monotonic())
+        left = _bg_pending
+
+    if left:
+        log(f"⚠️ background: {left} task(s) unfinished at shutdown")
+    stop_log_listener()
+    return left
+
+
+def background_stats():
+    with _bg_lock:
+        return {
+            **_bg_stats,
+            "depth": _bg_queue.qsize(),
+            "pending": _bg_pending,
+            "threads": len(_bg_threads),
+            "max_queue": BG_TASK_QUEUE,
+            "accepting": _bg_accepting,
+            "tasks": {name: dict(counts) for name, counts in _bg_stats_by_name.items()}
+        }
+
+
+@app.route("/background_stats", methods=["GET"])
+def get_background_stats():
+    return jsonify(background_stats())
+
+
+# log ผ่านคิว → thread ของ QueueListener เป็นคนเขียน stdout (request ไม่ติด I/O ของ log)
+_log_queue = queue.Queue()
+_log_listener = None
+_log_lock = threading.Lock()
+
+logger = logging.getLogger("retailstore")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+
+
+def log(*parts):
+    # ใช้แทน print(...) ใน request handler
+    global _log_listener
+    if _log_listener is None:
+        with _log_lock:
+            if _log_listener is None:
+                _log_listener = logging.handlers.QueueListener(
+                    _log_queue, logging.StreamHandler(sys.stdout)
+                )
+                _log_listener.start()
+    logger.info(" ".join(str(part) for part in parts))
+
+
+def stop_log_listener():
+    # เขียน log ที่ค้างในคิวให้หมด
+    global _log_listener
+    with _log_lock:
+        if _log_listener is not None:
+            _log_listener.stop()
+            _log_listener = None
+
+
+atexit.register(drain_background)
+
+# ---------------- Idempotency keys -------------------
+# client ส่ง header Idempotency-Key (เช่น uuid ต่อการกด 1 ครั้ง) → retry ด้วย key เดิมได้ผลเดิม
+# ครั้งแรก: ทำจริงแล้วเก็บ response ไว้ IDEMPOTENCY_TTL วินาที
+# ครั้งต่อไป: ตอบ response เดิม (Idempotent-Replayed: true) ไม่แตะ Firestore
+# กำลังทำอยู่ → 409, key เดิมแต่ body ไม่เหมือนเดิม → 422, ผล 5xx ไม่เก็บ (retry ทำใหม่ได้)
+# IDEMPOTENCY_FIRESTORE=1 → เก็บใน Firestore ด้วย ให้ worker อื่นเห็น
+# (ตั้ง TTL policy ของ Firestore ที่ field expiresAt ให้ลบเอง)
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", "3600"))
+IDEMPOTENCY_LOCK_TTL = float(os.environ.get("IDEMPOTENCY_LOCK_TTL", "60"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+IDEMPOTENCY_FIRESTORE = os.environ.get("IDEMPOTENCY_FIRESTORE", "0") == "1"
+IDEMPOTENCY_COLLECTION = "_idempotency"
+IDEMPOTENCY_MAX_BODY = 256 * 1024   # เอกสาร Firestore ต้องไม่เกิน 1 MB
+IDEMPOTENCY_KEY_MAX = 255
+
+_idempotency = OrderedDict()   # scope → {"state", "fingerprint", "status", "body", "mimetype", "expires"}
+_idempotency_lock = threading.Lock()
+_idempotency_stats = {"requests": 0, "replayed": 0, "in_progress": 0, "mismatch": 0}
+
+
+def _idem_count(name):
+    with _idempotency_lock:
+        _idempotency_stats[name] += 1
+
+
+def _idem_put(scope, entry):
+    # เรียกขณะถือ _idempotency_lock
+    _idempotency[scope] = entry
+    _idempotency.move_to_end(scope)
+    while len(_idempotency) > IDEMPOTENCY_MAX_ENTRIES:
+        _idempotency.popitem(last=False)
+
+
+def _idem_check(entry, fingerprint):
+    if entry["fingerprint"] != fingerprint:
+        return "mismatch"
+    return "replay" if entry["state"] == "done" else "in_progress"
+
+
+def _idem_claim_stored(scope, fingerprint):
+    # claim ใน Firestore ด้วย create() → worker เดียวได้ทำ
+    # คืน (state, entry) — state None = ได้สิทธิ์ทำ
+    doc_ref = db.collection(IDEMPOTENCY_COLLECTION).document(scope)
+    claim = {
+        "state": "in_progress",
+        "fingerprint": fingerprint,
+        "expiresAt": datetime.utcfromtimestamp(time.time() + IDEMPOTENCY_LOCK_TTL)
+    }
+    docs = request_docs()
+    try:
+        with docs.rpc(writes=1):
+            doc_ref.create(claim)
+        return None, None
+    except AlreadyExists:
+        pass
+
+    stored = docs.get(doc_ref)
+    data = stored.to_dict() if stored.exists else None
+    if data is None or data["expiresAt"].timestamp() < time.time():
+        # หมดอายุ (TTL ยังไม่ลบ) / worker ที่ claim ไว้ตายไป → ทำใหม่
+        # create() / last_update_time → สอง worker เห็นหมดอายุพร้อมกัน ได้สิทธิ์แค่ตัวเดียว
+        try:
+            with docs.rpc(writes=1):
+                if data is None:
+                    doc_ref.create(claim)
+                else:
+                    doc_ref.update(
+                        dict(claim, **{
+                            field: firestore.DELETE_FIELD
+                            for field in ("status", "body", "mimetype")
+                        }),
+                        option=db.write_option(last_update_time=stored.update_time)
+                    )
+            return None, None
+        except (AlreadyExists, FailedPrecondition):
+            docs.forget(doc_ref)
+            return "in_progress", None
+
+    entry = {
+        "state": data["state"],
+        "fingerprint": data["fingerprint"],
+        "status": data.get("status"),
+        "body": data.get("body"),
+        "mimetype": data.get("mimetype"),
+        "expires": time.monotonic() + data["expiresAt"].timestamp() - time.time()
+    }
+    return _idem_check(entry, fingerprint), entry
+
+
+def idempotency_begin(scope, fingerprint):
+    now = time.monotonic()
+    with _idempotency_lock:
+        entry = _idempotency.get(scope)
+        if entry is not None and entry["expires"] < now:
+            del _idempotency[scope]
+            entry = None
+
+        if entry is not None:
+            return _idem_check(entry, fingerprint), entry
+
+        # จองใน worker นี้ก่อน (request ซ้ำที่มาพร้อมกันใน worker เดียวกัน → 409)
+        _idem_put(scope, {
+            "state": "in_progress",
+            "fingerprint": fingerprint,
+            "expires": now + IDEMPOTENCY_LOCK_TTL
+        })
+
+    if not IDEMPOTENCY_FIRESTORE:
+        return None, None
+
+    try:
+        state, entry = _idem_claim_stored(scope, fingerprint)
+    except Exception as e:
+        # store ล่ม → ทำต่อแบบไม่มี idempotency ข้าม worker
+        log("🔥 ERROR idempotency store:", e)
+        return None, None
+
+    if state is not None:
+        with _idempotency_lock:
+            if state == "replay":
+                _idem_put(scope, entry)
+            else:
+                _idempotency.pop(scope, None)
+    return state, entry
+
+
+def _store_idempotent_response(scope, record):
+    db.collection(IDEMPOTENCY_COLLECTION).document(scope).set(record)
+
+
+def _forget_idempotent_response(scope):
+    db.collection(IDEMPOTENCY_COLLECTION).document(scope).delete()
+
+
+def idempotency_finish(scope, fingerprint, response):
+    body = response.get_data()
+    entry = {
+        "state": "done",
+        "fingerprint": fingerprint,
+        "status": response.status_code,
+        "body": body,
+        "mimetype": response.mimetype,
+        "expires": time.monotonic() + IDEMPOTENCY_TTL
+    }
+    with _idempotency_lock:
+        _idem_put(scope, entry)
+
+    if IDEMPOTENCY_FIRESTORE:
+        if len(body) > IDEMPOTENCY_MAX_BODY:
+            run_in_background("idempotency_forget", _forget_idempotent_response, scope, retries=2)
+            return
+        run_in_background("idempotency_store", _store_idempotent_response, scope, {
+            "state": "done",
+            "fingerprint": fingerprint,
+            "status": response.status_code,
+            "body": body,
+            "mimetype": response.mimetype,
+            "expiresAt": datetime.utcfromtimestamp(time.time() + IDEMPOTENCY_TTL)
+        }, retries=2)
+
+
+def idempotency_abort(scope):
+    with _idempotency_lock:
+        _idempotency.pop(scope, None)
+    if IDEMPOTENCY_FIRESTORE:
+        run_in_background("idempotency_forget", _forget_idempotent_response, scope, retries=2)
+
+
+def idempotent(view):
+    # วางใต้ @app.route ของ endpoint ที่เขียนข้อมูล (save_order, inc_preorder, confirm_order)
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if not key:
+            return view(*args, **kwargs)
+
+        if len(key) > IDEMPOTENCY_KEY_MAX:
+            return jsonify({
+                "status": "error",
+                "message": f"Idempotency-Key too long (max {IDEMPOTENCY_KEY_MAX})"
+            }), 400
+
+        _idem_count("requests")
+        scope = hashlib.sha256(f"{request.endpoint}\n{key}".encode("utf-8")).hexdigest()
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+
+        state, entry = idempotency_begin(scope, fingerprint)
+
+        if state == "replay":
+            _idem_count("replayed")
+            response = app.response_class(
+                entry["body"], status=entry["status"], mimetype=entry["mimetype"]
+            )
+            response.headers["Idempotent-Replayed"] = "true"
+            return response
+
+        if state == "in_progress":
+            _idem_count("in_progress")
+            return jsonify({
+                "status": "error",
+                "message": "A request with this Idempotency-Key is in progress"
+            }), 409
+
+        if state == "mismatch":
+            _idem_count("mismatch")
+            return jsonify({
+                "status": "error",
+                "message": "Idempotency-Key was used with a different request body"
+            }), 422
+
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except Exception:
+            idempotency_abort(scope)
+            raise
+
+        if response.status_code < 500 and not response.is_streamed:
+            idempotency_finish(scope, fingerprint, response)
+        else:
+            idempotency_abort(scope)
+        return response
+
+    return wrapper
+
+
+@app.route("/idempotency_stats", methods=["GET"])
+def get_idempotency_stats():
+    with _idempotency_lock:
+        stats = dict(_idempotency_stats)
+        stats["entries"] = len(_idempotency)
+    stats["ttl"] = IDEMPOTENCY_TTL
+    stats["firestore"] = IDEMPOTENCY_FIRESTORE
+    return jsonify(stats)
+
+# ---------------- Bucket index (cache ของ list_blobs) -------------------
+# ดู bucketindex.py
+BUCKET_INDEX_TTL = float(os.environ.get("BUCKET_INDEX_TTL", "300"))
+
+_bucket_index = BucketIndex(
+    lambda prefix: (blob.name for blob in bucket.list_blobs(prefix=prefix)),
+    BUCKET_INDEX_TTL
+)
+get_bucket_index = _bucket_index.get
+bucket_index_add = _bucket_index.add
+
+# ---------------- Image view cache (disk LRU) -------------------
+# cache ไฟล์รูปจาก bucket ลง disk แยกตาม (path, generation)
+# ขนาดรวมทุก worker ไม่เกิน IMAGE_CACHE_MAX_BYTES, เกินแล้วลบไฟล์ที่ใช้ล่าสุดนานที่สุดก่อน
+# แต่ละ worker ใช้ directory ของตัวเอง (IMAGE_CACHE_DIR/<pid>) → ไม่ลบไฟล์ที่ worker อื่นกำลังส่ง
+# และได้โควตา IMAGE_CACHE_MAX_BYTES / จำนวน worker ที่มี directory อยู่และยังไม่ตาย
+# (นับเองทุก IMAGE_CACHE_WORKERS_TTL วินาที เพราะ gunicorn -w / config file ไม่ตั้ง WEB_CONCURRENCY
+#  ถ้าตั้ง WEB_CONCURRENCY ไว้ → ใช้เป็นค่าต่ำสุด กัน worker ที่ยังไม่เริ่มใช้ cache)
+# directory ของ process ที่ตายแล้ว (restart / max_requests) → ลบตอน worker ใหม่เริ่มใช้ cache
+IMAGE_CACHE_DIR = os.environ.get(
+    "IMAGE_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "image_view_cache")
+)
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+IMAGE_CACHE_MIN_WORKERS = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+IMAGE_CACHE_WORKERS_TTL = float(os.environ.get("IMAGE_CACHE_WORKERS_TTL", "30"))
+# ภายในช่วงนี้ถือว่า generation ที่รู้อยู่ยังถูกต้อง → ส่งจาก cache โดยไม่ถาม GCS
+IMAGE_META_TTL = float(os.environ.get("IMAGE_META_TTL", "60"))
+
+_image_cache = OrderedDict()   # (path, generation) → {"file": ..., "size": ...}
+_image_meta = {}               # path → {"generation": ..., "checked_at": ...}
+_image_cache_bytes = 0
+_image_cache_stats = {"hits": 0, "misses": 0, "downloads": 0, "evictions": 0}
+_image_cache_lock = threading.Lock()
+_image_cache_pid = None
+_image_cache_workers = {"count": IMAGE_CACHE_MIN_WORKERS, "counted_at": None}
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _image_cache_dir():
+    # เรียกครั้งแรกใน process นี้ (หลัง gunicorn fork) → สร้าง directory + เก็บกวาดของ process เก่า
+    global _image_cache_pid
+    pid = os.getpid()
+    workdir = os.path.join(IMAGE_CACHE_DIR, str(pid))
+    if _image_cache_pid == pid:
+        return workdir
+
+    with _image_cache_lock:
+        if _image_cache_pid != pid:
+            os.makedirs(workdir, exist_ok=True)
+            for name in os.listdir(IMAGE_CACHE_DIR):
+                path = os.path.join(IMAGE_CACHE_DIR, name)
+                if name.isdigit() and os.path.isdir(path):
+                    if int(name) != pid and not _pid_alive(int(name)):
+                        shutil.rmtree(path, ignore_errors=True)
+                elif os.path.isfile(path):
+                    # ไฟล์จาก layout เดิม (directory เดียวร่วมกัน)
+                    _remove_files([path])
+            _image_cache_pid = pid
+
+    return workdir
+
+
+def _image_cache_worker_bytes():
+    # ต้องถือ _image_cache_lock อยู่
+    now = time.monotonic()
+    counted_at = _image_cache_workers["counted_at"]
+    if counted_at is None or now - counted_at > IMAGE_CACHE_WORKERS_TTL:
+        try:
+            live = sum(
+                1 for name in os.listdir(IMAGE_CACHE_DIR)
+                if name.isdigit() and _pid_alive(int(name))
+            )
+        except OSError:
+            live = 1
+        _image_cache_workers.update(count=max(live, IMAGE_CACHE_MIN_WORKERS), counted_at=now)
+
+    return IMAGE_CACHE_MAX_BYTES // _image_cache_workers["count"]
+
+
+def _image_cache_file(path, generation):
+    key = hashlib.sha1(f"{path}#{generation}".encode("utf-8")).hexdigest()
+    return os.path.join(_image_cache_dir(), key)
+
+
+def _remove_files(filenames):
+    for filename in filenames:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+
+def _write_file_atomic(path, data):
+    part = f"{path}.{uuid.uuid4().hex[:6]}.part"
+    with open(part, "wb") as f:
+        f.write(data)
+    os.replace(part, path)
+
+
+def _image_cache_lookup(key):
+    # ต้องถือ _image_cache_lock อยู่
+    entry = _image_cache.get(key)
+    if entry and os.path.exists(entry["file"]):
+        _image_cache.move_to_end(key)
+        _image_cache_stats["hits"] += 1
+        return entry["file"]
+    return None
+
+
+def _image_cache_put(key, filename, size):
+    global _image_cache_bytes
+    evicted = []
+
+    with _image_cache_lock:
+        if key in _image_cache:
+            _image_cache.move_to_end(key)
+            return
+
+        _image_cache[key] = {"file": filename, "size": size}
+        _image_cache_bytes += size
+
+        worker_bytes = _image_cache_worker_bytes()
+        while _image_cache_bytes > worker_bytes and len(_image_cache) > 1:
+            _, old = _image_cache.popitem(last=False)
+            _image_cache_bytes -= old["size"]
+            _image_cache_stats["evictions"] += 1
+            evicted.append(old["file"])
+
+    _remove_files(evicted)
+
+
+def _image_cache_drop(key):
+    global _image_cache_bytes
+
+    with _image_cache_lock:
+        old = _image_cache.pop(key, None)
+        if old:
+            _image_cache_bytes -= old["size"]
+
+    if old:
+        _remove_files([old["file"]])
+
+
+def get_cached_image(path):
+    # คืน (ไฟล์บน disk, generation) หรือ None ถ้าไม่มี blob นี้
+    now = time.monotonic()
+
+    with _image_cache_lock:
+        meta = _image_meta.get(path)
+        if meta and now - meta["checked_at"] < IMAGE_META_TTL:
+            filename = _image_cache_lookup((path, meta["generation"]))
+            if filename:
+                return filename, meta["generation"]
+
+    # 1 RPC: ได้ทั้ง exists และ generation (แทน blob.exists())
+    blob = bucket.get_blob(path)
+    if blob is None:
+        with _image_cache_lock:
+            _image_meta.pop(path, None)
+        return None
+
+    generation = blob.generation
+    key = (path, generation)
+
+    with _image_cache_lock:
+        _image_meta[path] = {"generation": generation, "checked_at": now}
+        stale = meta["generation"] if meta and meta["generation"] != generation else None
+
+        filename = _image_cache_lookup(key)
+        if filename:
+            return filename, generation
+
+        _image_cache_stats["misses"] += 1
+
+    # ไฟล์ถูกเขียนทับ → generation เก่าไม่ใช้แล้ว
+    if stale is not None:
+        _image_cache_drop((path, stale))
+
+    filename = _image_cache_file(path, generation)
+
+    # thread อื่นใน worker นี้อาจโหลดไว้แล้ว
+    if not os.path.exists(filename):
+        part = f"{filename}.{uuid.uuid4().hex[:6]}.part"
+        try:
+            # blob มี generation ติดมา → โหลดตรง version ที่เช็คไว้
+            blob.download_to_filename(part)
+            os.replace(part, filename)
+        finally:
+            _remove_files([part])
+
+        with _image_cache_lock:
+            _image_cache_stats["downloads"] += 1
+
+    _image_cache_put(key, filename, os.path.getsize(filename))
+    return filename, generation
+
+
+def image_cache_stats():
+    with _image_cache_lock:
+        stats = dict(_image_cache_stats)
+        stats["entries"] = len(_image_cache)
+        stats["bytes"] = _image_cache_bytes
+        stats["worker_max_bytes"] = _image_cache_worker_bytes()
+        stats["workers"] = _image_cache_workers["count"]
+
+    stats["max_bytes"] = IMAGE_CACHE_MAX_BYTES
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+    return stats
+
+# ---------------- Image edit result cache -------------------
+# รูปเดิม + prompt/model/size เดิม → ได้ผลเดิม ไม่ต้องเรียก OpenAI ซ้ำ
+# key = sha256 ของทั้งหมด, เก็บ 2 ชั้น: memory (เร็ว) และ disk (อยู่รอด restart)
+EDIT_IMAGE_MODEL = "gpt-image-1"
+EDIT_IMAGE_SIZE = "1024x1024"
+EDIT_IMAGE_PROMPT = (
+    "expand canvas on top and bottom with pure white background, "
+    "keep original subject unchanged, clean full white background, "
+    "sharpen, enhance clarity, improve lighting"
+)
+
+EDIT_CACHE_DIR = os.environ.get(
+    "EDIT_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "edit_image_cache")
+)
+EDIT_CACHE_MEM_BYTES = int(os.environ.get("EDIT_CACHE_MEM_BYTES", str(64 * 1024 * 1024)))
+EDIT_CACHE_DISK_BYTES = int(os.environ.get("EDIT_CACHE_DISK_BYTES", str(1024 * 1024 * 1024)))
+# disk ใช้ร่วมกันทุก worker → scan directory ใหม่เป็นระยะ ให้เห็นไฟล์ของ worker อื่นตอนคุมขนาด
+EDIT_CACHE_RESCAN = float(os.environ.get("EDIT_CACHE_RESCAN", "60"))
+
+os.makedirs(EDIT_CACHE_DIR, exist_ok=True)
+
+_edit_cache_mem = OrderedDict()    # key → bytes
+_edit_cache_disk = OrderedDict()   # key → size
+_edit_cache_mem_bytes = 0
+_edit_cache_disk_bytes = 0
+_edit_cache_stats = {"mem_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+_edit_cache_lock = threading.Lock()
+_edit_cache_scanned_at = 0.0
+
+
+def _load_edit_cache_index():
+    # ไฟล์ใน directory (รอบก่อน + worker อื่น) → เรียงตาม mtime (เก่าสุดถูกลบก่อน)
+    # disk hit แตะ mtime ไว้ → ลำดับ LRU ตรงกันทุก worker
+    global _edit_cache_disk_bytes, _edit_cache_scanned_at
+
+    files = []
+    for name in os.listdir(EDIT_CACHE_DIR):
+        path = os.path.join(EDIT_CACHE_DIR, name)
+        if name.endswith(".part"):
+            continue
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        files.append((stat.st_mtime, name, stat.st_size))
+
+    with _edit_cache_lock:
+        _edit_cache_disk.clear()
+        _edit_cache_disk_bytes = 0
+        for _, name, size in sorted(files):
+            _edit_cache_disk[name] = size
+            _edit_cache_disk_bytes += size
+        _edit_cache_scanned_at = time.monotonic()
+
+
+_load_edit_cache_index()
+
+
+def edit_cache_key(image_bytes, prompt=EDIT_IMAGE_PROMPT, model=EDIT_IMAGE_MODEL, size=EDIT_IMAGE_SIZE):
+    h = hashlib.sha256()
+    h.update(image_bytes)
+    for part in (prompt, model, size):
+        h.update(b"\0")
+        h.update(part.encode("utf-8"))
+    return h.hexdigest()
+
+
+def _edit_cache_mem_put(key, data):
+    # ต้องถือ _edit_cache_lock อยู่
+    global _edit_cache_mem_bytes
+
+    if key in _edit_cache_mem:
+        _edit_cache_mem.move_to_end(key)
+        return
+
+    _edit_cache_mem[key] = data
+    _edit_cache_mem_bytes += len(data)
+
+    while _edit_cache_mem_bytes > EDIT_CACHE_MEM_BYTES and _edit_cache_mem:
+        _, old = _edit_cache_mem.popitem(last=False)
+        _edit_cache_mem_bytes -= len(old)
+
+
+def edit_cache_get(key):
+    global _edit_cache_disk_bytes
+
+    with _edit_cache_lock:
+        data = _edit_cache_mem.get(key)
+        if data is not None:
+            _edit_cache_mem.move_to_end(key)
+            _edit_cache_stats["mem_hits"] += 1
+            return data
+
+    # ไม่ดู index ของ worker นี้ → เจอไฟล์ที่ worker อื่นเพิ่งเขียนด้วย
+    path = os.path.join(EDIT_CACHE_DIR, key)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)
+    except OSError:
+        data = None
+
+    with _edit_cache_lock:
+        if data is None:
+            # worker อื่นลบไปแล้ว
+            _edit_cache_disk_bytes -= _edit_cache_disk.pop(key, 0)
+            _edit_cache_stats["misses"] += 1
+            return None
+
+        _edit_cache_disk_put(key, len(data))
+        _edit_cache_mem_put(key, data)
+        _edit_cache_stats["disk_hits"] += 1
+        return data
+
+
+def _edit_cache_disk_put(key, size):
+    # ต้องถือ _edit_cache_lock อยู่
+    global _edit_cache_disk_bytes
+
+    if key in _edit_cache_disk:
+        _edit_cache_disk.move_to_end(key)
+        return
+
+    _edit_cache_disk[key] = size
+    _edit_cache_disk_bytes += size
+
+
+def edit_cache_put(key, data):
+    global _edit_cache_disk_bytes
+
+    _write_file_atomic(os.path.join(EDIT_CACHE_DIR, key), data)
+
+    if time.monotonic() - _edit_cache_scanned_at > EDIT_CACHE_RESCAN:
+        _load_edit_cache_index()
+
+    evicted = []
+    with _edit_cache_lock:
+        _edit_cache_mem_put(key, data)
+        _edit_cache_disk_put(key, len(data))
+
+        while _edit_cache_disk_bytes > EDIT_CACHE_DISK_BYTES and len(_edit_cache_disk) > 1:
+            old_key, old_size = _edit_cache_disk.popitem(last=False)
+            _edit_cache_disk_bytes -= old_size
+            _edit_cache_stats["evictions"] += 1
+            evicted.append(os.path.join(EDIT_CACHE_DIR, old_key))
+
+    _remove_files(evicted)
+
+
+def edit_cache_stats():
+    with _edit_cache_lock:
+        stats = dict(_edit_cache_stats)
+        stats["mem_entries"] = len(_edit_cache_mem)
+        stats["mem_bytes"] = _edit_cache_mem_bytes
+        stats["disk_entries"] = len(_edit_cache_disk)
+        stats["disk_bytes"] = _edit_cache_disk_bytes
+
+    stats["mem_max_bytes"] = EDIT_CACHE_MEM_BYTES
+    stats["disk_max_bytes"] = EDIT_CACHE_DISK_BYTES
+    lookups = stats["mem_hits"] + stats["disk_hits"] + stats["misses"]
+    hits = stats["mem_hits"] + stats["disk_hits"]
+    stats["hit_rate"] = round(hits / lookups, 4) if lookups else 0.0
+    return stats
+
+# ---------------- Image edit jobs -------------------
+# mode=async → รับงานแล้วตอบ jobId ทันที, ให้ thread pool เรียก OpenAI แทน worker ของ gunicorn
+# สถานะ/ผลลัพธ์เก็บเป็นไฟล์ใน EDIT_JOB_DIR → worker อื่นบนเครื่องเดียวกันตอบ poll ได้
+EDIT_JOB_DIR = os.environ.get(
+    "EDIT_JOB_DIR",
+    os.path.join(tempfile.gettempdir(), "edit_image_jobs")
+)
+EDIT_JOB_CONCURRENCY = int(os.environ.get("EDIT_JOB_CONCURRENCY", "2"))
+EDIT_JOB_MAX_QUEUE = int(os.environ.get("EDIT_JOB_MAX_QUEUE", "20"))
+EDIT_JOB_TTL = float(os.environ.get("EDIT_JOB_TTL", "3600"))
+
+os.makedirs(EDIT_JOB_DIR, exist_ok=True)
+
+_edit_executor = ThreadPoolExecutor(
+    max_workers=EDIT_JOB_CONCURRENCY,
+    thread_name_prefix="edit_image"
+)
+_edit_job_pending = 0   # queued + running ใน worker นี้
+_edit_job_lock = threading.Lock()
+
+
+def run_image_edit(image_bytes, mime):
+    key = edit_cache_key(image_bytes)
+    cached = edit_cache_get(key)
+    if cached is not None:
+        return cached
+
+    edited = client.images.edit(
+        model=EDIT_IMAGE_MODEL,
+        image=("image.jpg", image_bytes, mime),
+        prompt=EDIT_IMAGE_PROMPT,
+        size=EDIT_IMAGE_SIZE
+    )
+
+    result_bytes = base64.b64decode(edited.data[0].b64_json)
+    edit_cache_put(key, result_bytes)
+    return result_bytes
+
+
+def _edit_job_file(job_id, ext):
+    return os.path.join(EDIT_JOB_DIR, f"{job_id}.{ext}")
+
+
+def _save_edit_job(job):
+    _write_file_atomic(
+        _edit_job_file(job["jobId"], "json"),
+        json.dumps(job).encode("utf-8")
+    )
+
+
+def get_edit_job(job_id):
+    # jobId เป็น uuid hex เท่านั้น (กัน path traversal)
+    if not job_id.isalnum():
+        return None
+    try:
+        with open(_edit_job_file(job_id, "json"), "rb") as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def _prune_edit_jobs():
+    cutoff = time.time() - EDIT_JOB_TTL
+    for name in os.listdir(EDIT_JOB_DIR):
+        path = os.path.join(EDIT_JOB_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _run_edit_job(job, run, args):
+    global _edit_job_pending
+
+    try:
+        job.update(status="running", startedAt=time.time())
+        _save_edit_job(job)
+
+        result_bytes = run(*args)
+        _write_file_atomic(_edit_job_file(job["jobId"], "png"), result_bytes)
+
+        job.update(status="done", finishedAt=time.time())
+        _save_edit_job(job)
+
+    except Exception as e:
+        log("🔥 ERROR edit job:", traceback.format_exc())
+        job.update(status="error", error=str(e), finishedAt=time.time())
+        _save_edit_job(job)
+
+    finally:
+        with _edit_job_lock:
+            _edit_job_pending -= 1
+
+
+def submit_edit_job(run, *args):
+    # run(*args) → PNG bytes (run_image_edit / run_local_edit), คืน None ถ้าคิวเต็ม
+    global _edit_job_pending
+
+    with _edit_job_lock:
+        if _edit_job_pending >= EDIT_JOB_CONCURRENCY + EDIT_JOB_MAX_QUEUE:
+            return None
+        _edit_job_pending += 1
+
+    try:
+        _prune_edit_jobs()
+
+        job = {
+            "jobId": uuid.uuid4().hex,
+            "status": "queued",
+            "createdAt": time.time()
+        }
+        _save_edit_job(job)
+        _edit_executor.submit(_run_edit_job, job, run, args)
+
+    except Exception:
+        with _edit_job_lock:
+            _edit_job_pending -= 1
+        raise
+
+    return job
+
+# ---------------- Image process pool -------------------
+# งาน Pillow (CPU) ทั้งหมดรันใน process pool นี้ (imageops.py)
+# spawn → process ลูก import แค่ imageops ไม่ fork ทั้ง worker (Firebase/gRPC threads)
+# process ลูกตาย (เช่น OOM กับ PNG ใหญ่มาก) → pool เสียถาวร (BrokenProcessPool) → สร้างใหม่
+IMAGE_POOL_PROCESSES = int(os.environ.get("IMAGE_POOL_PROCESSES", str(os.cpu_count() or 1)))
+
+
+def _new_image_pool():
+    return ProcessPoolExecutor(
+        max_workers=IMAGE_POOL_PROCESSES,
+        mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+_image_pool = _new_image_pool()
+_image_pool_lock = threading.Lock()
+
+
+def _replace_image_pool(broken):
+    global _image_pool
+    with _image_pool_lock:
+        if _image_pool is broken:
+            log("⚠️ image pool broken, restarting")
+            _image_pool = _new_image_pool()
+    broken.shutdown(wait=False)
+
+
+def image_pool_submit(fn, *args, **kwargs):
+    pool = _image_pool
+    try:
+        future = pool.submit(fn, *args, **kwargs)
+    except BrokenProcessPool:
+        _replace_image_pool(pool)
+        pool = _image_pool
+        future = pool.submit(fn, *args, **kwargs)
+
+    def on_done(f):
+        # งานนี้ทำ process ลูกตาย → request ถัดไปได้ pool ใหม่
+        if not f.cancelled() and isinstance(f.exception(), BrokenProcessPool):
+            _replace_image_pool(pool)
+
+    future.add_done_callback(on_done)
+    return future
+
+# ---------------- Local image edit (Pillow) -------------------
+# engine=local (ค่าเริ่มต้น) → ขยาย canvas ขาว + autocontrast + unsharp ในเครื่อง
+# engine=ai → gpt-image-1 เหมือนเดิม; ตั้ง EDIT_IMAGE_ENGINE=ai เพื่อใช้ AI เป็นค่าเริ่มต้น
+EDIT_IMAGE_ENGINE = os.environ.get("EDIT_IMAGE_ENGINE", "local")
+
+
+def run_local_edit(image_bytes, fmt="PNG"):
+    return image_pool_submit(imageops.white_canvas_edit, image_bytes, fmt=fmt).result()
+
+# ---------------- Image variants (thumb / list / detail) -------------------
+# ทุกครั้งที่ upload รูปสินค้า → สร้างรูปย่อเก็บไว้ที่ _variants/<path ไม่มีนามสกุล>/<ชื่อขนาด>.webp
+# แยก root ออกมา → ไม่ปนกับ get_all_categories / get_modesonline / get_view_list
+# upload ทุกจุดส่ง predefined_acl="publicRead" ไปพร้อมไฟล์ → ไม่ต้องเรียก make_public() แยก
+VARIANT_ROOT = "_variants"
+VARIANT_FORMAT = os.environ.get("VARIANT_FORMAT", "WEBP").upper()
+VARIANT_EXT = "jpg" if VARIANT_FORMAT == "JPEG" else "webp"
+IMAGE_VARIANTS = {"thumb": 256, "list": 640, "detail": 1280}
+GCS_UPLOAD_THREADS = int(os.environ.get("GCS_UPLOAD_THREADS", "8"))
+
+BULK_UPLOAD_THREADS = int(os.environ.get("BULK_UPLOAD_THREADS", "16"))
+BULK_UPLOAD_MAX_FILES = int(os.environ.get("BULK_UPLOAD_MAX_FILES", "1000"))
+
+_upload_executor = ThreadPoolExecutor(
+    max_workers=GCS_UPLOAD_THREADS,
+    thread_name_prefix="gcs_upload"
+)
+# แยก pool ของ bulk upload: งานใน pool นี้ไปรอ _upload_executor ได้โดยไม่ deadlock
+_bulk_executor = ThreadPoolExecutor(
+    max_workers=BULK_UPLOAD_THREADS,
+    thread_name_prefix="bulk_upload"
+)
+
+# storage client ใช้ HTTP session ตัวเดียวร่วมกันทุก thread (keep-alive)
+# ขยาย connection pool ให้พอกับจำนวน thread ไม่งั้น urllib3 ทิ้ง connection แล้วเปิดใหม่
+bucket.client._http.mount(
+    "https://",
+    requests.adapters.HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=GCS_UPLOAD_THREADS + BULK_UPLOAD_THREADS
+    )
+)
+
+
+def variant_path(path, name):
+    stem = path.rsplit(".", 1)[0] if "." in path.split("/")[-1] else path
+    return f"{VARIANT_ROOT}/{stem}/{name}.{VARIANT_EXT}"
+
+
+def _upload_variant(path, data):
+    blob = bucket.blob(path)
+    blob.cache_control = "public, max-age=86400"
+    blob.upload_from_string(
+        data,
+        content_type=f"image/{'jpeg' if VARIANT_EXT == 'jpg' else VARIANT_EXT}",
+        predefined_acl="publicRead"
+    )
+    bucket_index_add(path)
+    return blob.public_url
+
+
+def start_image_variants(image_bytes):
+    # เริ่ม decode/ย่อใน process pool ทันที ระหว่างนั้น request thread upload ต้นฉบับไปก่อน
+    try:
+        return image_pool_submit(imageops.make_variants, image_bytes, IMAGE_VARIANTS, VARIANT_FORMAT)
+    except Exception:
+        log("🔥 ERROR image variants:", traceback.format_exc())
+        return None
+
+
+def finish_image_variants(path, future):
+    # คืน {"thumb": url, "list": url, "detail": url}; รูปเสีย / pool ล่ม → {} (ไม่ทำให้ upload ล้ม)
+    if future is None:
+        return {}
+
+    try:
+        variants = future.result()
+        uploads = {
+            name: _upload_executor.submit(_upload_variant, variant_path(path, name), data)
+            for name, data in variants.items()
+        }
+        return {name: f.result() for name, f in uploads.items()}
+
+    except Exception:
+        log("🔥 ERROR image variants:", traceback.format_exc())
+        return {}
+
+
+def find_variant_url(path, name):
+    # มีรูปย่อของ path นี้ไหม (ดูจาก bucket index, ไม่ยิง GCS ทุกครั้ง)
+    vpath = variant_path(path, name)
+    prefix = "/".join(vpath.split("/")[:2]) + "/"
+    names = get_bucket_index(prefix)["names"]
+
+    i = bisect.bisect_left(names, vpath)
+    if i < len(names) and names[i] == vpath:
+        return bucket.blob(vpath).public_url
+    return None
+
+
+def variant_url_for(image_url, name):
+    # image_url = public URL ของต้นฉบับ → URL ของรูปย่อ (ไม่มี → คืน URL เดิม)
+    base = f"https://storage.googleapis.com/{bucket.name}/"
+    if not name or not image_url or not image_url.startswith(base):
+        return image_url
+
+    path = urllib.parse.unquote(image_url[len(base):])
+    return find_variant_url(path, name) or image_url
+
 # --------------------------- IMAGE EDIT ---------------------------
 @app.route("/edit_image", methods=["POST"])
 def edit_image():
@@ -56,19 +1279,38 @@ def edit_image():
 
         image_file = request.files["image"]
         mime = image_file.mimetype or "image/jpeg"
+        image_bytes = image_file.read()
 
-        edited = client.images.edit(
-            model="gpt-image-1",
-            image=("image.jpg", image_file.stream, mime),
-            prompt=(
-                "expand canvas on top and bottom with pure white background, "
-                "keep original subject unchanged, clean full white background, "
-                "sharpen, enhance clarity, improve lighting"
-            ),
-            size="1024x1024"
-        )
+        engine = request.values.get("engine", EDIT_IMAGE_ENGINE)
+
+        # 🕒 mode=async → ตอบ jobId ทันที แล้ว poll ที่ /edit_image/jobs/<jobId> (ทั้งสอง engine, ผลเป็น PNG)
+        if request.values.get("mode") == "async":
+            if engine == "ai":
+                job = submit_edit_job(run_image_edit, image_bytes, mime)
+            else:
+                job = submit_edit_job(run_local_edit, image_bytes)
+            if job is None:
+                return jsonify({"error": "Image edit queue is full"}), 429
+
+            return jsonify({
+                "status": job["status"],
+                "jobId": job["jobId"],
+                "statusUrl": f"/edit_image/jobs/{job['jobId']}",
+                "resultUrl": f"/edit_image/jobs/{job['jobId']}/result"
+            }), 202
+
+        # ⚡ engine=local → ทำในเครื่อง ไม่กี่สิบ ms ไม่ต้องเข้าคิว
+        if engine != "ai":
+            fmt = "JPEG" if request.values.get("format") in ("jpg", "jpeg") else "PNG"
+            result_bytes = run_local_edit(image_bytes, fmt)
+
+            return send_file(
+                BytesIO(result_bytes),
+                mimetype=f"image/{fmt.lower()}",
+                as_attachment=False
+            )
 
-        result_bytes = base64.b64decode(edited.data[0].b64_json)
+        result_bytes = run_image_edit(image_bytes, mime)
 
         return send_file(
             BytesIO(result_bytes),
@@ -77,8 +1319,38 @@ def edit_image():
         )
 
     except Exception as e:
-        traceback.print_exc()
+        log("🔥 ERROR edit_image:", traceback.format_exc())
         return jsonify({"error": str(e)}), 500
+
+
+@app.route("/edit_cache_stats", methods=["GET"])
+def get_edit_cache_stats():
+    return jsonify(edit_cache_stats())
+
+
+@app.route("/edit_image/jobs/<job_id>", methods=["GET"])
+def edit_image_job_status(job_id):
+    job = get_edit_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    return jsonify(job)
+
+
+@app.route("/edit_image/jobs/<job_id>/result", methods=["GET"])
+def edit_image_job_result(job_id):
+    job = get_edit_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    if job["status"] != "done":
+        return jsonify(job), 409
+
+    return send_file(
+        _edit_job_file(job_id, "png"),
+        mimetype="image/png",
+        as_attachment=False
+    )
     #--------------------- บันทึกจาก สร้างสินค้าด้วยตัวเอง -------
 @app.route("/upload_product_image", methods=["POST"])
 def upload_product_image():
@@ -99,17 +1371,24 @@ def upload_product_image():
         blob_path = f"modeproduct/{folder_name}/{filename}"
         blob = bucket.blob(blob_path)
 
-        # ⬆️ 3) upload
-        blob.upload_from_file(
-            image,
-            content_type="image/jpeg"
+        # ⬆️ 3) upload (+ รูปย่อทำขนานกันใน process pool)
+        image_bytes = image.read()
+        variants_future = start_image_variants(image_bytes)
+
+        blob.upload_from_string(
+            image_bytes,
+            content_type="image/jpeg",
+            predefined_acl="publicRead"
         )
 
-        blob.make_public()
+        bucket_index_add(blob_path)
+
+        variants = finish_image_variants(blob_path, variants_future)
 
         return jsonify({
             "message": "upload success",
-            "image_url": blob.public_url
+            "image_url": blob.public_url,
+            "variants": variants
         })
 
     except Exception as e:
@@ -125,12 +1404,12 @@ def get_view_list():
 
         # prefix ต้องรวม "modeproduct/"
         prefix = f"modeproduct/{folder}/"
-        blobs = bucket.list_blobs(prefix=prefix)
+        names = get_bucket_index(prefix)["names"]
 
         filenames = [
-            blob.name.replace(prefix, "")  # เอาเฉพาะชื่อไฟล์
-            for blob in blobs
-            if "." in blob.name
+            name.replace(prefix, "")  # เอาเฉพาะชื่อไฟล์
+            for name in names
+            if "." in name
         ]
 
         return jsonify(filenames), 200
@@ -151,32 +1430,34 @@ def get_all_categories():
                 "message": "Missing shopname"
             }), 400
 
-        blobs = bucket.list_blobs(prefix=f"{shopname}/")
+        # ?variant=thumb → ใช้รูปย่อเป็น thumbnail ถ้ามี
+        variant = request.args.get("variant")
 
-        categories = {}
+        folders = get_bucket_index(f"{shopname}/")["folders"]
 
-        for blob in blobs:
-            # ตัวอย่าง blob.name:
-            # shop1/mode1/pic11.jpg
-            parts = blob.name.split("/")
+        categories = {}
 
-            # ต้องเป็น shop/mode/file
-            if len(parts) != 3:
-                continue
+        for mode, filenames in folders.items():
+            # ตัวอย่าง: shop1/mode1/pic11.jpg → folders["mode1"] = ["pic11.jpg"]
+            for filename in filenames:
+                # ต้องเป็น shop/mode/file
+                if "/" in filename:
+                    continue
 
-            _, mode, filename = parts
+                # ข้ามไฟล์ที่ไม่ใช่รูป
+                if not filename.lower().endswith((".jpg", ".jpeg", ".png", ".webp")):
+                    continue
 
-            # ข้ามไฟล์ที่ไม่ใช่รูป
-            if not filename.lower().endswith((".jpg", ".jpeg", ".png", ".webp")):
-                continue
+                # ✅ ใช้รูปแรกของ mode เป็น thumbnail
+                image_url = None
+                if variant:
+                    image_url = find_variant_url(f"{shopname}/{mode}/{filename}", variant)
 
-            # ✅ ถ้ายังไม่มี mode นี้ → ใช้รูปแรกเป็น thumbnail
-            if mode not in categories:
-                image_url = (
+                categories[mode] = image_url or (
                     f"https://storage.googleapis.com/"
-                    f"{bucket.name}/{blob.name}"
+                    f"{bucket.name}/{shopname}/{mode}/{filename}"
                 )
-                categories[mode] = image_url
+                break
 
         result = [
             {
@@ -203,21 +1484,41 @@ def get_all_categories():
 def image_view(folder, filename):
     try:
         # folder ต้องส่งชื่อหมวดจริง เช่น "สินค้าสุขภาพ"
-        blob = bucket.blob(f"modeproduct/{folder}/{filename}")
-        if not blob.exists():
-            return jsonify({"error": "File not found"}), 404
-
-        temp = tempfile.NamedTemporaryFile(delete=False)
-        blob.download_to_filename(temp.name)
+        path = f"modeproduct/{folder}/{filename}"
 
         ext = filename.lower().split('.')[-1]
         mimetype = f"image/{'jpeg' if ext == 'jpg' else ext}"
 
-        return send_file(temp.name, mimetype=mimetype)
+        # ไฟล์ถูก evict ระหว่าง lookup กับ send_file → โหลดใหม่อีกครั้ง
+        for attempt in range(2):
+            cached = get_cached_image(path)
+            if cached is None:
+                return jsonify({"error": "File not found"}), 404
+
+            cache_file, generation = cached
+
+            try:
+                # conditional=True → รองรับ If-None-Match (304) และ Range (206) + stream จากไฟล์
+                # send_file เปิดไฟล์ทันที → ลบทีหลังก็ยังส่งจนจบ
+                return send_file(
+                    cache_file,
+                    mimetype=mimetype,
+                    conditional=True,
+                    etag=str(generation),
+                    max_age=int(IMAGE_META_TTL)
+                )
+            except FileNotFoundError:
+                if attempt:
+                    raise
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+
+@app.route('/image_cache_stats', methods=['GET'])
+def get_image_cache_stats():
+    return jsonify(image_cache_stats())
+
     #-----------------------
 @app.route("/update_mode", methods=["POST"])
 def update_mode():
@@ -236,21 +1537,28 @@ def update_mode():
         path = f"{folder_name}/{picturename}"
         blob = bucket.blob(path)
 
-        blob.upload_from_file(
-            file,
-            content_type=file.mimetype or "image/jpeg"
+        image_bytes = file.read()
+        variants_future = start_image_variants(image_bytes)
+
+        blob.upload_from_string(
+            image_bytes,
+            content_type=file.mimetype or "image/jpeg",
+            predefined_acl="publicRead"
         )
-        blob.make_public()
+        bucket_index_add(path)
+
+        variants = finish_image_variants(path, variants_future)
 
         return jsonify({
             "status": "success",
             "folder_name": folder_name,
             "path": path,
-            "public_url": blob.public_url
+            "public_url": blob.public_url,
+            "variants": variants
         }), 200
 
     except Exception as e:
-        traceback.print_exc()
+        log("🔥 ERROR update_mode:", traceback.format_exc())
         return jsonify({
             "status": "error",
             "message": str(e)
@@ -288,14 +1596,20 @@ def upload_image_with_folder():
         blob = bucket.blob(path)
 
         # ===============================
-        # 🔹 upload + fix content-type
+        # 🔹 upload + fix content-type (+ รูปย่อ)
         # ===============================
-        blob.upload_from_file(
-            file,
-            content_type="image/jpeg"
+        image_bytes = file.read()
+        variants_future = start_image_variants(image_bytes)
+
+        blob.upload_from_string(
+            image_bytes,
+            content_type="image/jpeg",
+            predefined_acl="publicRead"
         )
 
-        blob.make_public()
+        bucket_index_add(path)
+
+        variants = finish_image_variants(path, variants_future)
 
         return jsonify({
             "status": "success",
@@ -303,11 +1617,139 @@ def upload_image_with_folder():
             "folder_name": folder_name,
             "filename": picturename,
             "path": path,
-            "public_url": blob.public_url
+            "public_url": blob.public_url,
+            "variants": variants
+        }), 200
+
+    except Exception as e:
+        log("🔥 ERROR upload_image_with_folder:", traceback.format_exc())
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
+
+# --------------------------- Bulk Upload Images ---------------
+# ลงรูปทั้งร้านทีเดียว: หลายไฟล์ (images) หรือ zip (zip_file) → shopname/folder_name/<ชื่อไฟล์>
+IMAGE_CONTENT_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp"
+}
+
+
+def _bulk_upload_one(shopname, folder_name, filename, read_bytes, with_variants):
+    result = {"filename": filename}
+
+    try:
+        ext = os.path.splitext(filename)[1].lower()
+        content_type = IMAGE_CONTENT_TYPES.get(ext)
+        if not content_type:
+            result.update(status="error", message="Unsupported file type")
+            return result
+
+        path = f"{shopname}/{folder_name}/{filename}"
+        image_bytes = read_bytes()
+        variants_future = start_image_variants(image_bytes) if with_variants else None
+
+        # upload + ACL ใน request เดียว (แทน make_public() อีกรอบ)
+        blob = bucket.blob(path)
+        blob.upload_from_string(
+            image_bytes,
+            content_type=content_type,
+            predefined_acl="publicRead"
+        )
+        bucket_index_add(path)
+
+        result.update(
+            status="success",
+            path=path,
+            public_url=blob.public_url,
+            variants=finish_image_variants(path, variants_future) if variants_future else {}
+        )
+
+    except Exception as e:
+        log("🔥 ERROR bulk upload:", traceback.format_exc())
+        result.update(status="error", message=str(e))
+
+    return result
+
+
+def _bulk_zip_entries(zip_file):
+    zf = zipfile.ZipFile(zip_file.stream)
+    lock = threading.Lock()   # ZipFile อ่านพร้อมกันหลาย thread ไม่ได้
+
+    def reader(info):
+        def read_bytes():
+            with lock:
+                return zf.read(info)
+        return read_bytes
+
+    for info in zf.infolist():
+        filename = os.path.basename(info.filename)
+        if info.is_dir() or not filename or filename.startswith(".") \
+                or info.filename.startswith("__MACOSX/"):
+            continue
+        yield filename, reader(info)
+
+
+@app.route("/upload_images_bulk", methods=["POST"])
+def upload_images_bulk():
+    try:
+        shopname = request.form.get("shopname")
+        folder_name = request.form.get("folder_name")
+        with_variants = request.form.get("variants", "1") != "0"
+        files = request.files.getlist("images")
+        zip_file = request.files.get("zip_file")
+
+        if not shopname or not folder_name or (not files and not zip_file):
+            return jsonify({
+                "status": "error",
+                "message": "Missing fields"
+            }), 400
+
+        # (ชื่อไฟล์, ฟังก์ชันอ่าน bytes) → อ่านใน thread ตอนจะ upload, ไม่โหลดทั้งหมดเข้า memory
+        entries = [
+            (os.path.basename(f.filename or "").strip(), f.read)
+            for f in files
+        ]
+        if zip_file:
+            entries.extend(_bulk_zip_entries(zip_file))
+
+        if len(entries) > BULK_UPLOAD_MAX_FILES:
+            return jsonify({
+                "status": "error",
+                "message": f"Too many files (max {BULK_UPLOAD_MAX_FILES})"
+            }), 400
+
+        futures = [
+            _bulk_executor.submit(
+                _bulk_upload_one, shopname, folder_name, filename, read_bytes, with_variants
+            )
+            for filename, read_bytes in entries
+        ]
+        results = [f.result() for f in futures]
+
+        uploaded = sum(1 for r in results if r["status"] == "success")
+
+        return jsonify({
+            "status": "success" if uploaded == len(results) else "partial",
+            "shopname": shopname,
+            "folder_name": folder_name,
+            "uploaded": uploaded,
+            "failed": len(results) - uploaded,
+            "results": results
         }), 200
 
+    except zipfile.BadZipFile:
+        return jsonify({
+            "status": "error",
+            "message": "Invalid zip file"
+        }), 400
+
     except Exception as e:
-        traceback.print_exc()
+        log("🔥 ERROR upload_images_bulk:", traceback.format_exc())
         return jsonify({
             "status": "error",
             "message": str(e)
@@ -333,6 +1775,7 @@ def create_shop_folder():
 
         if not blob.exists():
             blob.upload_from_string("", content_type="text/plain")
+        bucket_index_add(folder_path)
 
         return jsonify({
             "status": "success",
@@ -341,7 +1784,7 @@ def create_shop_folder():
         }), 200
 
     except Exception as e:
-        traceback.print_exc()
+        log("🔥 ERROR create_shop_folder:", traceback.format_exc())
         return jsonify({
             "status": "error",
             "message": str(e)
@@ -387,11 +1830,52 @@ def check_password():
         return jsonify({"status": "wrong_password"}), 200
 
 #-------------------------------------------
+def product_fields(data):
+    # ===============================
+    # รับค่าตัวเลข (กันพัง) → dict ที่บันทึกลง Firestore
+    # ===============================
+    try:
+        num_remainpack = int(data.get("num_remainpack", 0))
+    except:
+        num_remainpack = 0
+
+    try:
+        numpack = int(data.get("numpack", 0))
+    except:
+        numpack = 0
+
+    unitproduct = data.get("unitproduct", "")
+
+    try:
+        pricepack = float(data.get("pricepack", 0))
+    except:
+        pricepack = 0.0
+
+    # ✅ รองรับ pricesingle + priceSingle
+    try:
+        pricesingle = float(
+            data.get("pricesingle") or
+            data.get("priceSingle") or
+            0
+        )
+    except:
+        pricesingle = 0.0
+
+    return {
+        "num_remainpack": num_remainpack,
+        "numpack": numpack,
+        "unitproduct": unitproduct,
+        "pricepack": pricepack,
+        "pricesingle": pricesingle,
+        "productname": data.get("productname"),
+        "image_url": data.get("image_url", "")
+    }
+
+
 @app.route("/save_product_price", methods=["POST"])
 def save_product_price():
     try:
         data = request.get_json()
-        print("📦 JSON RECEIVED:", data)
 
         if not data:
             return jsonify({
@@ -405,7 +1889,6 @@ def save_product_price():
         shopname = data.get("shopname") or data.get("Shopname")
         textmode = data.get("textmode") or data.get("Textmode")
         productname = data.get("productname")
-        image_url = data.get("image_url", "")
 
         if not shopname or not textmode or not productname:
             return jsonify({
@@ -416,54 +1899,16 @@ def save_product_price():
         # ===============================
         # 2️⃣ รับค่าตัวเลข (กันพัง)
         # ===============================
-        try:
-            num_remainpack = int(data.get("num_remainpack", 0))
-        except:
-            num_remainpack = 0
-
-        try:
-            numpack = int(data.get("numpack", 0))
-        except:
-            numpack = 0
-
-        unitproduct = data.get("unitproduct", "")
-
-        try:
-            pricepack = float(data.get("pricepack", 0))
-        except:
-            pricepack = 0.0
-
-        # ✅ รองรับ pricesingle + priceSingle
-        try:
-            pricesingle = float(
-                data.get("pricesingle") or
-                data.get("priceSingle") or
-                0
-            )
-        except:
-            pricesingle = 0.0
+        fields = product_fields(data)
 
         # ===============================
         # 3️⃣ บันทึก Firestore
- 
- 
         # ===============================
-        db.collection(shopname) \
-          .document("mode") \
-          .collection(textmode) \
-            .document("product") \
-            .collection("products") \
+        products_ref(shopname, textmode) \
             .document(productname) \
-          .set({
-              
-              "num_remainpack": num_remainpack,
-              "numpack": numpack,
-              "unitproduct": unitproduct,
-              "pricepack": pricepack,
-              "pricesingle": pricesingle,
-              "productname":productname,
-              "image_url": image_url
-          }, merge=True)
+            .set(fields, merge=True)
+
+        catalog_cache_patch(shopname, textmode, productname, fields)
 
         return jsonify({
             "status": "success",
@@ -471,7 +1916,141 @@ def save_product_price():
         }), 200
 
     except Exception as e:
-        print("🔥 ERROR:", e)
+        log("🔥 ERROR:", e)
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
+#-------------------- บันทึกสินค้าทีละหลายรายการ --------------------------------
+# body: {"shopname": ..., "products": [{textmode, productname, ...}, ...]}
+#   หรือ NDJSON (Content-Type: application/x-ndjson) บรรทัดละ 1 สินค้า (?shopname= ใช้เป็นค่าเริ่มต้น)
+# เขียนเป็น WriteBatch ละไม่เกิน 500 รายการ, commit หลาย batch พร้อมกัน
+FIRESTORE_BATCH_LIMIT = 500
+BULK_PRODUCTS_MAX = int(os.environ.get("BULK_PRODUCTS_MAX", "5000"))
+
+
+def _read_bulk_products():
+    # คืน (shopname เริ่มต้น, list ของ (index, item))
+    if request.mimetype in ("application/x-ndjson", "application/jsonl"):
+        shopname = request.args.get("shopname")
+        items = []
+        for line in request.stream:
+            line = line.strip()
+            if line:
+                items.append(json.loads(line))
+        return shopname, items
+
+    data = request.get_json()
+    if isinstance(data, list):
+        return request.args.get("shopname"), data
+
+    data = data or {}
+    return data.get("shopname") or data.get("Shopname"), data.get("products") or []
+
+
+def _commit_product_chunk(chunk):
+    # chunk = list ของ (index, shopname, textmode, productname, fields)
+    batch = db.batch()
+    for _, shopname, textmode, productname, fields in chunk:
+        batch.set(products_ref(shopname, textmode).document(productname), fields, merge=True)
+    batch.commit()
+
+    for _, shopname, textmode, productname, fields in chunk:
+        catalog_cache_patch(shopname, textmode, productname, fields)
+
+
+@app.route("/save_products_bulk", methods=["POST"])
+def save_products_bulk():
+    try:
+        try:
+            default_shopname, items = _read_bulk_products()
+        except ValueError as e:
+            return jsonify({
+                "status": "error",
+                "message": f"Invalid JSON: {e}"
+            }), 400
+
+        if not items:
+            return jsonify({
+                "status": "error",
+                "message": "No products"
+            }), 400
+
+        if len(items) > BULK_PRODUCTS_MAX:
+            return jsonify({
+                "status": "error",
+                "message": f"Too many products (max {BULK_PRODUCTS_MAX})"
+            }), 400
+
+        results = [None] * len(items)
+        writes = []
+
+        for i, item in enumerate(items):
+            if not isinstance(item, dict):
+                results[i] = {"index": i, "status": "error", "message": "Item must be an object"}
+                continue
+
+            shopname = item.get("shopname") or item.get("Shopname") or default_shopname
+            textmode = item.get("textmode") or item.get("Textmode")
+            productname = item.get("productname")
+
+            if not shopname or not textmode or not productname:
+                results[i] = {
+                    "index": i,
+                    "productname": productname,
+                    "status": "error",
+                    "message": "Missing shopname, textmode, or productname"
+                }
+                continue
+
+            if not isinstance(productname, str) or not isinstance(textmode, str) \
+                    or "/" in productname or "/" in textmode:
+                results[i] = {
+                    "index": i,
+                    "productname": productname,
+                    "status": "error",
+                    "message": "Invalid productname or textmode"
+                }
+                continue
+
+            writes.append((i, shopname, textmode, productname, product_fields(item)))
+
+        chunks = [
+            writes[n:n + FIRESTORE_BATCH_LIMIT]
+            for n in range(0, len(writes), FIRESTORE_BATCH_LIMIT)
+        ]
+        futures = [_bulk_executor.submit(_commit_product_chunk, chunk) for chunk in chunks]
+
+        for chunk, future in zip(chunks, futures):
+            try:
+                future.result()
+                error = None
+            except Exception as e:
+                log("🔥 ERROR save_products_bulk:", traceback.format_exc())
+                error = str(e)
+
+            for i, shopname, textmode, productname, _ in chunk:
+                results[i] = {
+                    "index": i,
+                    "textmode": textmode,
+                    "productname": productname,
+                    "status": "error" if error else "success"
+                }
+                if error:
+                    results[i]["message"] = error
+
+        saved = sum(1 for r in results if r["status"] == "success")
+
+        return jsonify({
+            "status": "success" if saved == len(results) else "partial",
+            "saved": saved,
+            "failed": len(results) - saved,
+            "results": results
+        }), 200
+
+    except Exception as e:
+        log("🔥 ERROR save_products_bulk:", e)
         return jsonify({
             "status": "error",
             "message": str(e)
@@ -511,11 +2090,289 @@ def get_products():
 
     return jsonify(result)
     #---------------------------------------
+# ---------------- Catalog cache (get_products_by_mode) -------------------
+# เก็บสินค้าของแต่ละ (shopname, textmode) + JSON ที่ serialize แล้ว
+# hit → ไม่อ่าน Firestore และไม่ jsonify ใหม่; save_product_price patch ของ worker ตัวเอง
+# worker อื่นเห็นของใหม่เมื่อหมด CATALOG_CACHE_TTL
+CATALOG_CACHE_TTL = float(os.environ.get("CATALOG_CACHE_TTL", "60"))
+CATALOG_CACHE_MAX_ENTRIES = int(os.environ.get("CATALOG_CACHE_MAX_ENTRIES", "500"))
+
+_catalog_cache = OrderedDict()   # (shopname, textmode) → {"docs": {id: data}, "json": {(variant, fields): bytes}, "loaded_at": ...}
+_catalog_versions = {}           # (shopname, textmode) → เลขเพิ่มทุกครั้งที่เขียน (กันโหลดเก่าทับของใหม่)
+_catalog_cache_stats = {"hits": 0, "misses": 0, "patches": 0}
+_catalog_cache_lock = threading.Lock()
+
+
+def products_ref(shopname, textmode):
+    return db.collection(shopname) \
+        .document("mode") \
+        .collection(textmode) \
+        .document("product") \
+        .collection("products")
+
+
+PRODUCT_FIELDS = (
+    "productname", "num_remainpack", "pricesingle", "numpack",
+    "pricepack", "image_url", "unitproduct"
+)
+
+
+def product_json(data, variant=None, fields=None):
+    product = {
+        "productname": data.get("productname", ""),
+        "num_remainpack": data.get("num_remainpack", 0),
+        "pricesingle": data.get("pricesingle", 0),
+        "numpack": data.get("numpack", 0),
+        "pricepack": data.get("pricepack", 0),
+        "image_url": variant_url_for(data.get("image_url", ""), variant),
+        "unitproduct": data.get("unitproduct", "")
+    }
+    if fields:
+        product = {name: product[name] for name in fields}
+    return product
+
+
+def _load_catalog_docs(shopname, textmode):
+    return {doc.id: doc.to_dict() for doc in products_ref(shopname, textmode).stream()}
+
+
+def catalog_docs(shopname, textmode):
+    # สินค้าทั้งหมดของ mode (dict id → data) — ทางเดียวที่เติม cache
+    key = (shopname, textmode)
+    now = time.monotonic()
+    live = CATALOG_LIVE and catalog_watch(key)
+
+    with _catalog_cache_lock:
+        entry = _catalog_cache.get(key)
+        if entry and (live or now - entry["loaded_at"] < CATALOG_CACHE_TTL):
+            _catalog_cache.move_to_end(key)
+            _catalog_cache_stats["hits"] += 1
+            return entry["docs"]
+
+        _catalog_cache_stats["misses"] += 1
+        version = _catalog_versions.get(key, 0)
+
+    docs = _load_catalog_docs(shopname, textmode)
+
+    with _catalog_cache_lock:
+        if _catalog_versions.get(key, 0) == version:
+            _catalog_cache[key] = {"docs": docs, "json": {}, "loaded_at": now}
+            _catalog_cache.move_to_end(key)
+
+            while len(_catalog_cache) > CATALOG_CACHE_MAX_ENTRIES:
+                _catalog_cache.popitem(last=False)
+
+    return docs
+
+
+def catalog_response_body(shopname, textmode, variant=None, fields=None):
+    # JSON ที่ serialize แล้วเก็บแยกตาม (variant, fields) ใน entry ของ catalog_docs
+    key = (shopname, textmode)
+    body_key = (variant, fields)
+
+    docs = catalog_docs(shopname, textmode)
+
+    with _catalog_cache_lock:
+        entry = _catalog_cache.get(key)
+        if entry is not None and entry["docs"] is docs:
+            body = entry["json"].get(body_key)
+            if body is not None:
+                return body
+
+    body = jsonify({
+        "status": "success",
+        "products": [product_json(data, variant, fields) for data in docs.values()]
+    }).get_data()
+
+    with _catalog_cache_lock:
+        # entry ยังเป็นชุดเดิม (ไม่ถูก patch / โหลดใหม่ระหว่าง serialize) → เก็บ JSON ไว้
+        entry = _catalog_cache.get(key)
+        if entry is not None and entry["docs"] is docs:
+            entry["json"] = {**entry["json"], body_key: body}
+
+    return body
+
+
+def catalog_cache_patch(shopname, textmode, doc_id, fields):
+    # เขียนสินค้าแบบ merge → merge ลง cache ด้วย แล้วล้าง JSON ที่ serialize ไว้
+    key = (shopname, textmode)
+
+    with _catalog_cache_lock:
+        _catalog_versions[key] = _catalog_versions.get(key, 0) + 1
+
+        modes = _shop_modes.get(shopname)
+        if modes and textmode not in modes["modes"]:
+            modes["modes"] = sorted(modes["modes"] + [textmode])
+
+        entry = _catalog_cache.get(key)
+        if entry is None:
+            return
+
+        docs = dict(entry["docs"])
+        if doc_id in docs:
+            docs[doc_id] = {**docs[doc_id], **fields}
+        else:
+            # Firestore stream เรียงตาม doc id → เรียงให้เหมือนกัน
+            docs[doc_id] = dict(fields)
+            docs = dict(sorted(docs.items()))
+
+        entry["docs"] = docs
+        entry["json"] = {}
+        _catalog_cache_stats["patches"] += 1
+
+
+# ---------------- Live catalog mirror (on_snapshot) -------------------
+# CATALOG_LIVE=1 → ร้านที่มีคนเปิดดู ติด listener ที่ collection สินค้าของ mode นั้น
+# Firestore ส่งเฉพาะที่เปลี่ยน → ค่าอ่านตามจำนวนการแก้ ไม่ใช่จำนวนคนเปิดดู
+# ไม่มีคนดูเกิน CATALOG_LIVE_IDLE วินาที → ถอด listener
+CATALOG_LIVE = os.environ.get("CATALOG_LIVE", "0") == "1"
+CATALOG_LIVE_IDLE = float(os.environ.get("CATALOG_LIVE_IDLE", "600"))
+CATALOG_LIVE_MAX_WATCHES = int(os.environ.get("CATALOG_LIVE_MAX_WATCHES", "200"))
+CATALOG_LIVE_WAIT = float(os.environ.get("CATALOG_LIVE_WAIT", "5"))
+
+_catalog_watches = {}   # (shopname, textmode) → {"watch": ..., "ready": Event, "timed_out": ..., "last_used": ...}
+_catalog_reaper = None
+
+
+def _on_catalog_snapshot(key, col_snapshot, changes, read_time):
+    # col_snapshot = สินค้าทั้งหมดของ collection ณ ตอนนี้ (ไม่ใช่แค่ที่เปลี่ยน)
+    docs = {doc.id: doc.to_dict() for doc in sorted(col_snapshot, key=lambda d: d.id)}
+
+    with _catalog_cache_lock:
+        _catalog_versions[key] = _catalog_versions.get(key, 0) + 1
+        _catalog_cache[key] = {"docs": docs, "json": {}, "loaded_at": time.monotonic()}
+
+        while len(_catalog_cache) > CATALOG_CACHE_MAX_ENTRIES:
+            _catalog_cache.popitem(last=False)
+
+        watch = _catalog_watches.get(key)
+        if watch:
+            watch["ready"].set()
+
+
+def _reap_catalog_watches():
+    while True:
+        time.sleep(min(60, CATALOG_LIVE_IDLE))
+        now = time.monotonic()
+
+        with _catalog_cache_lock:
+            idle = [
+                key for key, watch in _catalog_watches.items()
+                if now - watch["last_used"] > CATALOG_LIVE_IDLE
+                or (watch["watch"] is not None and not watch["watch"].is_active)
+            ]
+            removed = [_catalog_watches.pop(key) for key in idle]
+
+        for watch in removed:
+            try:
+                watch["watch"].unsubscribe()
+            except Exception:
+                log("🔥 ERROR catalog watch unsubscribe:", traceback.format_exc())
+
+
+def catalog_watch(key):
+    # คืน True ถ้ามี listener พร้อมใช้ (ติดให้ถ้ายังไม่มี)
+    global _catalog_reaper
+
+    with _catalog_cache_lock:
+        watch = _catalog_watches.get(key)
+        if watch is not None and watch["watch"] is not None and not watch["watch"].is_active:
+            # listener ตาย (network / permission) → ติดใหม่ ไม่ต้องรอ reaper
+            _catalog_watches.pop(key)
+            watch = None
+
+        if watch is None:
+            if len(_catalog_watches) >= CATALOG_LIVE_MAX_WATCHES:
+                return False
+
+            watch = {
+                "watch": None,
+                "ready": threading.Event(),
+                "timed_out": False,
+                "last_used": time.monotonic()
+            }
+            _catalog_watches[key] = watch
+            attach = True
+        else:
+            watch["last_used"] = time.monotonic()
+            attach = False
+
+        if _catalog_reaper is None:
+            _catalog_reaper = threading.Thread(target=_reap_catalog_watches, daemon=True)
+            _catalog_reaper.start()
+
+    if attach:
+        try:
+            watch["watch"] = products_ref(*key).on_snapshot(
+                lambda col_snapshot, changes, read_time:
+                    _on_catalog_snapshot(key, col_snapshot, changes, read_time)
+            )
+        except Exception:
+            log("🔥 ERROR catalog watch:", traceback.format_exc())
+            with _catalog_cache_lock:
+                _catalog_watches.pop(key, None)
+            return False
+
+    # snapshot แรกเคยรอจนหมดเวลาแล้ว → ไม่รอซ้ำทุก request, อ่าน Firestore ตรงจนกว่าจะพร้อม
+    if watch["timed_out"]:
+        return watch["ready"].is_set()
+
+    if not watch["ready"].wait(CATALOG_LIVE_WAIT):
+        watch["timed_out"] = True
+        return False
+    return True
+
+
+def catalog_cache_stats():
+    with _catalog_cache_lock:
+        stats = dict(_catalog_cache_stats)
+        stats["entries"] = len(_catalog_cache)
+        stats["live_watches"] = len(_catalog_watches)
+
+    stats["max_entries"] = CATALOG_CACHE_MAX_ENTRIES
+    stats["ttl"] = CATALOG_CACHE_TTL
+    return stats
+
+
+def catalog_page(shopname, textmode, cursor, page_size, fields=None):
+    # หน้าเดียวของสินค้า: cache สด → ตัดจาก memory, ไม่งั้นอ่าน Firestore แค่หน้านั้น
+    key = (shopname, textmode)
+    live = CATALOG_LIVE and catalog_watch(key)
+    now = time.monotonic()
+
+    with _catalog_cache_lock:
+        entry = _catalog_cache.get(key)
+        if entry and (live or now - entry["loaded_at"] < CATALOG_CACHE_TTL):
+            _catalog_cache_stats["hits"] += 1
+            docs = entry["docs"]
+        else:
+            docs = None
+
+    if docs is None:
+        page, next_cursor = page_query(products_ref(shopname, textmode), cursor, page_size, fields)
+        return [doc.to_dict() for doc in page], next_cursor
+
+    ids = list(docs)   # เรียงตาม doc id เหมือน Firestore
+    start = 0
+    if cursor:
+        (last_id,) = decode_cursor(cursor, 1)
+        start = bisect.bisect_right(ids, last_id)
+
+    page_ids = ids[start:start + page_size]
+    next_cursor = None
+    if start + page_size < len(ids):
+        next_cursor = encode_cursor([page_ids[-1]])
+
+    return [docs[doc_id] for doc_id in page_ids], next_cursor
+
+
 @app.route("/get_products_by_mode", methods=["GET"])
 def get_products_by_mode():
     try:
         shopname = request.args.get("shopname")
         textmode = request.args.get("textmode")
+        variant = request.args.get("variant")   # thumb / list / detail
+        cursor = request.args.get("cursor")
 
         if not shopname or not textmode:
             return jsonify({
@@ -523,53 +2380,308 @@ def get_products_by_mode():
                 "message": "Missing shopname or textmode"
             }), 400
 
-        products_ref = db.collection(shopname) \
-          .document("mode") \
-          .collection(textmode) \
-            .document("product") \
-            .collection("products") \
-             
-          
-        docs = products_ref.stream()
+        try:
+            page_size = parse_page_size(request.args.get("page_size"))
+            # ✂️ fields=productname,pricesingle,image_url → ส่งเฉพาะ field ที่ขอ
+            fields = parse_fields(request.args.get("fields"), PRODUCT_FIELDS)
+
+            # 📄 แบ่งหน้า
+            if page_size or cursor:
+                page, next_cursor = catalog_page(
+                    shopname, textmode, cursor, page_size or PAGE_SIZE_MAX, fields
+                )
+                return jsonify({
+                    "status": "success",
+                    "products": [product_json(data, variant, fields) for data in page],
+                    "next_cursor": next_cursor
+                })
 
-        products = []
-        for doc in docs:
-            data = doc.to_dict()
-            products.append({
-                
-                "productname": doc.id,
-                
-                "num_remainpack": data.get("num_remainpack", 0),
-                "pricesingle": data.get("pricesingle", 0),  
-                "numpack": data.get("numpack", 0),   
-                "pricepack": data.get("pricepack", 0),  
-
-                
-                    "productname": data.get("productname", ""),
-                "image_url": data.get("image_url", ""),
-                 "unitproduct": data.get("unitproduct", "")
-                
-
-                
-            })
+        except ValueError as e:
+            return jsonify({
+                "status": "error",
+                "message": str(e)
+            }), 400
+
+        body = catalog_response_body(shopname, textmode, variant, fields)
+
+        return app.response_class(body, mimetype="application/json")
+
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
+
+@app.route("/catalog_cache_stats", methods=["GET"])
+def get_catalog_cache_stats():
+    return jsonify(catalog_cache_stats())
+
+# ---------------- Whole-shop catalog -------------------
+# หน้าร้าน: ทุก mode + สินค้าในคำขอเดียว (แทน get_modesonline + get_products_by_mode ทีละ mode)
+# mode = subcollection ใต้ {shopname}/mode (list_collections 1 RPC, cache ตาม CATALOG_CACHE_TTL)
+# แต่ละ mode อ่านผ่าน catalog cache พร้อมกันใน thread pool
+CATALOG_FANOUT_THREADS = int(os.environ.get("CATALOG_FANOUT_THREADS", "8"))
+
+_catalog_executor = ThreadPoolExecutor(
+    max_workers=CATALOG_FANOUT_THREADS,
+    thread_name_prefix="catalog"
+)
+_shop_modes = {}   # shopname → {"modes": [...], "loaded_at": ...} (ใช้ _catalog_cache_lock)
+
+
+def shop_modes(shopname):
+    now = time.monotonic()
+
+    with _catalog_cache_lock:
+        entry = _shop_modes.get(shopname)
+        if entry and now - entry["loaded_at"] < CATALOG_CACHE_TTL:
+            return entry["modes"]
+
+    modes = sorted(c.id for c in db.collection(shopname).document("mode").collections())
+
+    with _catalog_cache_lock:
+        _shop_modes[shopname] = {"modes": modes, "loaded_at": now}
+    return modes
+
+
+def _shop_catalog_mode(shopname, textmode, limit, variant, fields):
+    if limit:
+        page, next_cursor = catalog_page(shopname, textmode, None, limit, fields)
+    else:
+        page, next_cursor = catalog_docs(shopname, textmode).values(), None
+
+    return {
+        "mode": textmode,
+        "products": [product_json(data, variant, fields) for data in page],
+        "next_cursor": next_cursor
+    }
+
+
+@app.route("/get_shop_catalog", methods=["GET"])
+def get_shop_catalog():
+    try:
+        shopname = request.args.get("shopname")
+        variant = request.args.get("variant")
+
+        if not shopname:
+            return jsonify({
+                "status": "error",
+                "message": "Missing shopname"
+            }), 400
+
+        try:
+            # limit = จำนวนสินค้าสูงสุดต่อ mode (ที่เหลือใช้ next_cursor กับ get_products_by_mode)
+            limit = parse_page_size(request.args.get("limit"))
+            fields = parse_fields(request.args.get("fields"), PRODUCT_FIELDS)
+        except ValueError as e:
+            return jsonify({
+                "status": "error",
+                "message": str(e)
+            }), 400
+
+        modes = shop_modes(shopname)
+
+        futures = [
+            _catalog_executor.submit(_shop_catalog_mode, shopname, textmode, limit, variant, fields)
+            for textmode in modes
+        ]
 
         return jsonify({
             "status": "success",
-            "products": products
+            "shopname": shopname,
+            "modes": [f.result() for f in futures]
         })
 
     except Exception as e:
+        log("🔥 ERROR get_shop_catalog:", e)
         return jsonify({
             "status": "error",
             "message": str(e)
         }), 500
+# ---------------- Push notifications (FCM) -------------------
+# เครื่องของร้านลงทะเบียน token ที่ {shopname}/system/devices/{sha1(token)}
+# confirm_order → ส่ง FCM ไปทุกเครื่องของร้าน (send_each ทีละ 500) ใน background ไม่ถ่วง response
+# token ที่ FCM บอกว่าตายแล้ว (Unregistered / SenderIdMismatch) → ลบทิ้ง
+# get_notifications เหลือเป็น fallback แบบ poll ช้าๆ
+FCM_ENABLED = os.environ.get("FCM_ENABLED", "1") == "1"
+FCM_BATCH_LIMIT = 500
+DEVICE_TOKENS_TTL = float(os.environ.get("DEVICE_TOKENS_TTL", "300"))
+
+_device_tokens = {}   # shopname → (tokens, loaded_at)
+_device_tokens_lock = threading.Lock()
+_push_stats = {"pushes": 0, "sent": 0, "failed": 0, "pruned": 0, "errors": 0}
+_push_stats_lock = threading.Lock()
+
+
+def devices_ref(shopname):
+    return (
+        db.collection(shopname)
+          .document("system")
+          .collection("devices")
+    )
+
+
+def device_doc_id(token):
+    # token ยาว ~160 ตัวอักษร มี ":" → hash เป็น id (ลงทะเบียนซ้ำ = เขียนทับเอกสารเดิม)
+    return hashlib.sha1(token.encode("utf-8")).hexdigest()
+
+
+def shop_device_tokens(shopname):
+    with _device_tokens_lock:
+        entry = _device_tokens.get(shopname)
+    if entry and time.monotonic() - entry[1] < DEVICE_TOKENS_TTL:
+        return entry[0]
+
+    tokens = [
+        doc.to_dict().get("token")
+        for doc in devices_ref(shopname).select(["token"]).stream()
+    ]
+    tokens = [t for t in tokens if t]
+
+    with _device_tokens_lock:
+        _device_tokens[shopname] = (tokens, time.monotonic())
+    return tokens
+
+
+def forget_device_tokens(shopname):
+    with _device_tokens_lock:
+        _device_tokens.pop(shopname, None)
+
+
+def _count_push(**counts):
+    with _push_stats_lock:
+        for name, n in counts.items():
+            _push_stats[name] += n
+
+
+def prune_device_tokens(shopname, tokens):
+    collection_ref = devices_ref(shopname)
+    for n in range(0, len(tokens), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for token in tokens[n:n + FIRESTORE_BATCH_LIMIT]:
+            batch.delete(collection_ref.document(device_doc_id(token)))
+        batch.commit()
+    forget_device_tokens(shopname)
+    _count_push(pruned=len(tokens))
+
+
+def push_to_shop(shopname, title, body, data):
+    # รันใน background → ไม่ retry (ส่งซ้ำเครื่องที่ได้แล้ว), error แค่ log
+    try:
+        tokens = shop_device_tokens(shopname)
+        if not tokens:
+            return
+
+        # data ของ FCM ต้องเป็น str ทั้งหมด
+        data = {k: str(v) for k, v in data.items()}
+        dead = []
+
+        for n in range(0, len(tokens), FCM_BATCH_LIMIT):
+            chunk = tokens[n:n + FCM_BATCH_LIMIT]
+            messages = [
+                messaging.Message(
+                    token=token,
+                    notification=messaging.Notification(title=title, body=body),
+                    data=data,
+                    android=messaging.AndroidConfig(priority="high")
+                )
+                for token in chunk
+            ]
+            result = messaging.send_each(messages)
+            _count_push(pushes=1, sent=result.success_count, failed=result.failure_count)
+
+            for token, resp in zip(chunk, result.responses):
+                if not resp.success and isinstance(
+                    resp.exception,
+                    (messaging.UnregisteredError, messaging.SenderIdMismatchError)
+                ):
+                    dead.append(token)
+
+        if dead:
+            prune_device_tokens(shopname, dead)
+
+    except Exception:
+        _count_push(errors=1)
+        log("🔥 ERROR fcm push:", traceback.format_exc())
+
+
+def notify_shop_async(shopname, title, body, data):
+    if FCM_ENABLED:
+        run_in_background("fcm_push", push_to_shop, shopname, title, body, data)
+
+
+@app.route("/register_device", methods=["POST"])
+def register_device():
+    try:
+        data = request.get_json()
+        shopname = data.get("shopname")
+        token = data.get("token")
+
+        if not shopname or not token:
+            return jsonify({"status": "error", "message": "Missing shopname or token"}), 400
+
+        devices_ref(shopname).document(device_doc_id(token)).set({
+            "token": token,
+            "platform": data.get("platform", ""),
+            "updatedAt": firestore.SERVER_TIMESTAMP
+        })
+        forget_device_tokens(shopname)
+
+        return jsonify({"status": "success"})
+
+    except Exception as e:
+        log("🔥 ERROR register_device:", e)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route("/unregister_device", methods=["POST"])
+def unregister_device():
+    try:
+        data = request.get_json()
+        shopname = data.get("shopname")
+        token = data.get("token")
+
+        if not shopname or not token:
+            return jsonify({"status": "error", "message": "Missing shopname or token"}), 400
+
+        devices_ref(shopname).document(device_doc_id(token)).delete()
+        forget_device_tokens(shopname)
+
+        return jsonify({"status": "success"})
+
+    except Exception as e:
+        log("🔥 ERROR unregister_device:", e)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route("/push_stats", methods=["GET"])
+def get_push_stats():
+    with _push_stats_lock:
+        stats = dict(_push_stats)
+    with _device_tokens_lock:
+        stats["cached_shops"] = len(_device_tokens)
+    stats["enabled"] = FCM_ENABLED
+    return jsonify(stats)
+
+
     #-----------------------ยืนยันการสั้งซื้อสินค้า-----------
 from google.cloud import firestore
 
+# pool ของ confirm_order เอง → ไม่ต่อคิวหลัง bulk upload / save_products_bulk ใน _bulk_executor
+ORDER_COMMIT_THREADS = int(os.environ.get("ORDER_COMMIT_THREADS", "4"))
+
+_order_executor = ThreadPoolExecutor(
+    max_workers=ORDER_COMMIT_THREADS,
+    thread_name_prefix="order_commit"
+)
+
 @app.route("/confirm_order", methods=["POST"])
+@idempotent
 def confirm_order():
     try:
         data = request.get_json()
+        docs = request_docs()
 
         shopname = data.get("shopname")
         customerName = data.get("customerName")
@@ -594,50 +2706,54 @@ def confirm_order():
               .document(activeOrderId)
         )
 
-        if not order_ref.get().exists:
-            return jsonify({
-                "status": "error",
-                "message": "Order not found"
-            }), 404
+        # 1️⃣ เก็บ itemIds (select([]) → อ่านแค่ id ไม่ดึง field)
+        items_ref = order_ref.collection("items")
+        with docs.rpc() as call:
+            item_ids = [item.id for item in items_ref.select([]).stream()]   # ⭐ เก็บ ItemID
+            call["reads"] = max(len(item_ids), 1)
+
+        # 2️⃣ order ใหญ่เกิน 1 batch → commit items ส่วนเกินก่อน (พร้อมกัน)
+        #    batch สุดท้ายค่อยเปลี่ยน status order → เห็น "confirmed" เมื่อ items ครบแล้วเท่านั้น
+        head = FIRESTORE_BATCH_LIMIT - 4
+        extra_ids = item_ids[head:]
+
+        def commit_items(ids):
+            batch = db.batch()
+            for item_id in ids:
+                batch.update(items_ref.document(item_id), {"status": "confirmed"})
+            batch.commit()
 
-        # 1️⃣ update status order
-        order_ref.update({
+        futures = [
+            _order_executor.submit(commit_items, extra_ids[n:n + FIRESTORE_BATCH_LIMIT])
+            for n in range(0, len(extra_ids), FIRESTORE_BATCH_LIMIT)
+        ]
+        if futures:
+            started = time.perf_counter()
+            for f in futures:
+                f.result()
+            docs.note(len(futures), 0, len(extra_ids), (time.perf_counter() - started) * 1000)
+
+        # 3️⃣ order + items + ล้าง activeOrderId + 🔔 notification + unread counter → commit เดียว
+        batch = db.batch()
+
+        # update() → ถ้าไม่มี order ทั้ง batch ล้ม (NotFound) ไม่ต้อง get() เช็คก่อน
+        batch.update(order_ref, {
             "status": "confirmed",
             "confirmedAt": firestore.SERVER_TIMESTAMP
         })
 
-        # 2️⃣ update items + เก็บ itemIds
-        items_ref = order_ref.collection("items")
-        items = items_ref.stream()
-
-        batch = db.batch()
-        item_ids = []
-        count = 0
-
-        for item in items:
-            item_ids.append(item.id)   # ⭐ เก็บ ItemID
-            batch.update(item.reference, {
+        for item_id in item_ids[:head]:
+            batch.update(items_ref.document(item_id), {
                 "status": "confirmed"
             })
-            count += 1
-
-        if count > 0:
-            batch.commit()
 
-        # 3️⃣ ล้าง activeOrderId
-        customer_ref.update({
+        batch.set(customer_ref, {
             "activeOrderId": ""
-        })
-
-        # 🔔 4️⃣ สร้าง notification + itemIds
-        notif_ref = (
-            db.collection(shopname)
-              .document("system")
-              .collection("notifications")
-              .document(activeOrderId)
-        )
+        }, merge=True)
 
-        notif_ref.set({
+        # create() → confirm ซ้ำหลัง commit สำเร็จไปแล้ว ได้ AlreadyExists → counter ไม่บวกซ้ำ
+        notif_ref = notifications_ref(shopname).document(activeOrderId)
+        batch.create(notif_ref, {
             "type": "order_confirmed",
             "orderId": activeOrderId,
             "customerName": customerName,
@@ -645,16 +2761,59 @@ def confirm_order():
             "status": "unread",
             "createdAt": firestore.SERVER_TIMESTAMP
         })
+        batch.set(unread_counter_ref(shopname), {
+            "unread": firestore.Increment(1)
+        }, merge=True)
+
+        notified = False
+        try:
+            with docs.rpc(writes=len(item_ids[:head]) + 4):
+                batch.commit()
+            notified = True
+        except NotFound:
+            return jsonify({
+                "status": "error",
+                "message": "Order not found"
+            }), 404
+        except AlreadyExists:
+            # ทั้ง batch ไม่ได้เขียน → สำเร็จได้เฉพาะเมื่อ order นี้ยืนยันไปแล้วจริง
+            # notification id = activeOrderId (timestamp) ระดับร้าน → ลูกค้าอื่นอาจได้ id ชนกัน
+            order_doc, notif_doc = docs.get_many([order_ref, notif_ref], ["status", "customerName"])
+            confirmed = (
+                order_doc.exists
+                and order_doc.to_dict().get("status") == "confirmed"
+                and notif_doc.exists
+                and notif_doc.to_dict().get("customerName") == customerName
+            )
+            if not confirmed:
+                return jsonify({
+                    "status": "error",
+                    "message": "Order id conflicts with another confirmed order"
+                }), 409
+        set_active_order(shopname, customerName, None)
+
+        # 📲 แจ้งเครื่องของร้าน (ไม่รอ FCM)
+        if notified:
+            notify_shop_async(
+                shopname,
+                "ออเดอร์ใหม่",
+                f"{customerName} ยืนยันออเดอร์ {len(item_ids)} รายการ",
+                {
+                    "type": "order_confirmed",
+                    "orderId": activeOrderId,
+                    "customerName": customerName
+                }
+            )
 
         return jsonify({
             "status": "success",
             "orderId": activeOrderId,
-            "updatedItems": count,
+            "updatedItems": len(item_ids),
             "itemIds": item_ids
         })
 
     except Exception as e:
-        print("🔥 ERROR confirm_order:", e)
+        log("🔥 ERROR confirm_order:", e)
         return jsonify({
             "status": "error",
             "message": str(e)
@@ -669,15 +2828,38 @@ def get_notifications():
         if not shopname:
             return jsonify([])
 
-        notifications_ref = (
+        # 📄 ส่ง page_size / cursor มา → ตอบเป็น {"notifications": [...], "next_cursor": ...}
+        cursor = request.args.get("cursor")
+        try:
+            page_size = parse_page_size(request.args.get("page_size"), 50)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        paged = "page_size" in request.args or bool(cursor)
+
+        collection_ref = (
             db.collection(shopname)
               .document("system")
               .collection("notifications")
+        )
+
+        notifications_ref = (
+            collection_ref
               .order_by("createdAt", direction=firestore.Query.DESCENDING)
-              .limit(50)
+              .order_by("__name__", direction=firestore.Query.DESCENDING)
         )
 
-        docs = notifications_ref.stream()
+        if cursor:
+            try:
+                created_at, last_id = decode_cursor(cursor, 2)
+                created_at = datetime.fromisoformat(created_at)
+            except (TypeError, ValueError):
+                return jsonify({"error": "Invalid cursor"}), 400
+
+            notifications_ref = notifications_ref.start_after(
+                [created_at, collection_ref.document(last_id)]
+            )
+
+        docs = list(notifications_ref.limit(page_size).stream())
 
         result = []
         for doc in docs:
@@ -685,10 +2867,22 @@ def get_notifications():
             data["id"] = doc.id
             result.append(data)
 
-        return jsonify(result)
+        if not paged:
+            return jsonify(result)
+
+        next_cursor = None
+        if len(docs) == page_size:
+            last = docs[-1]
+            next_cursor = encode_cursor([last.get("createdAt").isoformat(), last.id])
+
+        return jsonify({
+            "status": "success",
+            "notifications": result,
+            "next_cursor": next_cursor
+        })
 
     except Exception as e:
-        print("🔥 ERROR get_notifications:", e)
+        log("🔥 ERROR get_notifications:", e)
         return jsonify({"error": str(e)}), 500
         
         #-------------------------------
@@ -706,7 +2900,17 @@ def get_notification_modes():
               .collection("notification_modes")
         )
 
-        docs = modes_ref.stream()
+        # 📄 ส่ง page_size / cursor มา → ตอบเป็น {"modes": [...], "next_cursor": ...}
+        cursor = request.args.get("cursor")
+        next_cursor = None
+        try:
+            page_size = parse_page_size(request.args.get("page_size"))
+            if page_size or cursor:
+                docs, next_cursor = page_query(modes_ref, cursor, page_size or PAGE_SIZE_MAX)
+            else:
+                docs = modes_ref.stream()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
         result = []
         for doc in docs:
@@ -714,45 +2918,638 @@ def get_notification_modes():
             data["id"] = doc.id
             result.append(data)
 
-        return jsonify(result)
+        if not page_size and not cursor:
+            return jsonify(result)
+
+        return jsonify({
+            "status": "success",
+            "modes": result,
+            "next_cursor": next_cursor
+        })
+
+    except Exception as e:
+        log("🔥 ERROR get_notification_modes:", e)
+        return jsonify({"error": str(e)}), 500
+
+
+# ---------------- Notification stream (SSE) -------------------
+# แทนการ poll get_notifications / get_notification_modes:
+# 1 listener (on_snapshot) ต่อร้านต่อ worker แชร์ให้ทุก client ที่เปิด stream ของร้านนั้น
+# Firestore ส่งเฉพาะเอกสารที่เปลี่ยน → ค่าอ่านไม่ขึ้นกับจำนวน client / ความถี่ในการ poll
+#
+# event id = update_time ของเอกสาร (microseconds) → ใช้ข้าม worker / restart ได้
+# reconnect พร้อม Last-Event-ID → ส่งเฉพาะเอกสารที่เปลี่ยนหลังจากนั้น (รวม removed จาก tombstone)
+# Last-Event-ID เก่ากว่าที่ hub นี้รู้ครบ (hub เพิ่งเริ่ม / tombstone ถูกตัด) → ส่ง snapshot ทั้งชุดแทน
+# ต้องรัน gunicorn แบบ gthread / gevent: sync worker (default) 1 connection = 1 worker → ตอบ 503 ให้ poll
+NOTIF_STREAM_WINDOW = int(os.environ.get("NOTIF_STREAM_WINDOW", "50"))
+NOTIF_STREAM_IDLE = float(os.environ.get("NOTIF_STREAM_IDLE", "120"))
+NOTIF_STREAM_MAX_SHOPS = int(os.environ.get("NOTIF_STREAM_MAX_SHOPS", "200"))
+NOTIF_STREAM_QUEUE = int(os.environ.get("NOTIF_STREAM_QUEUE", "500"))
+NOTIF_STREAM_HEARTBEAT = float(os.environ.get("NOTIF_STREAM_HEARTBEAT", "15"))
+NOTIF_STREAM_MAX_AGE = float(os.environ.get("NOTIF_STREAM_MAX_AGE", "300"))
+NOTIF_STREAM_WAIT = float(os.environ.get("NOTIF_STREAM_WAIT", "10"))
+NOTIF_STREAM_TOMBSTONES = int(os.environ.get("NOTIF_STREAM_TOMBSTONES", "200"))
+
+NOTIF_STREAM_KINDS = ("notifications", "modes")
+
+_notif_hubs = {}   # (shopname, kind) → {"watch", "ready", "docs", "tombstones", "complete_since", "subscribers", "idle_since"}
+_notif_hubs_lock = threading.Lock()
+_notif_reaper = None
+
+
+def _notif_query(shopname, kind):
+    system_ref = db.collection(shopname).document("system")
+    if kind == "modes":
+        return system_ref.collection("notification_modes")
+
+    # ชุดเดียวกับหน้าแรกของ get_notifications
+    return (
+        system_ref.collection("notifications")
+          .order_by("createdAt", direction=firestore.Query.DESCENDING)
+          .limit(NOTIF_STREAM_WINDOW)
+    )
+
+
+def _event_id(timestamp):
+    # DatetimeWithNanoseconds → int microseconds
+    return int(timestamp.timestamp() * 1_000_000)
+
+
+def _notif_event(change_type, doc_id, data, event_id):
+    return {"type": change_type, "id": doc_id, "data": data, "eventId": event_id}
+
+
+def _on_notif_snapshot(key, col_snapshot, changes, read_time):
+    with _notif_hubs_lock:
+        hub = _notif_hubs.get(key)
+        if hub is None:
+            return
+
+        if hub["complete_since"] is None:
+            # snapshot แรก → รู้ครบตั้งแต่ตอนนี้
+            hub["complete_since"] = _event_id(read_time)
+
+        for change in changes:
+            doc = change.document
+            tombstones = hub["tombstones"]
+            tombstones.pop(doc.id, None)
+
+            if change.type.name == "REMOVED":
+                # ออกจาก window (limit) หรือถูกลบ → เก็บ tombstone ไว้ให้ client ที่ resume
+                event = _notif_event("removed", doc.id, None, _event_id(read_time))
+                tombstones[doc.id] = None
+                while len(tombstones) > NOTIF_STREAM_TOMBSTONES:
+                    old_id, _ = tombstones.popitem(last=False)
+                    old = hub["docs"].pop(old_id, None)
+                    # resume ที่เก่ากว่านี้ไม่ครบแล้ว → ได้ snapshot
+                    if old is not None:
+                        hub["complete_since"] = max(hub["complete_since"], old["eventId"])
+            else:
+                data = doc.to_dict()
+                data["id"] = doc.id
+                event = _notif_event(
+                    change.type.name.lower(), doc.id, data, _event_id(doc.update_time)
+                )
+            hub["docs"][doc.id] = event
+
+            # snapshot แรก → client ยังไม่ได้ subscribe (รอ ready แล้วอ่านจาก docs เอง)
+            for q in list(hub["subscribers"]):
+                try:
+                    q.put_nowait(event)
+                except queue.Full:
+                    # client อ่านไม่ทัน → ตัดทิ้ง, reconnect แล้ว resume ด้วย Last-Event-ID
+                    hub["subscribers"].discard(q)
+                    with q.mutex:
+                        q.queue.clear()
+                    q.put_nowait(None)
+
+        hub["ready"].set()
+
+
+def _reap_notif_hubs():
+    while True:
+        time.sleep(min(60, NOTIF_STREAM_IDLE))
+        now = time.monotonic()
+
+        with _notif_hubs_lock:
+            idle = [
+                key for key, hub in _notif_hubs.items()
+                if not hub["subscribers"] and now - hub["idle_since"] > NOTIF_STREAM_IDLE
+            ]
+            removed = [_notif_hubs.pop(key) for key in idle]
+
+        for hub in removed:
+            try:
+                if hub["watch"] is not None:
+                    hub["watch"].unsubscribe()
+            except Exception:
+                log("🔥 ERROR notification hub unsubscribe:", traceback.format_exc())
+
+
+def notif_hub(key):
+    # คืน hub ที่มี listener พร้อมใช้ (ติดให้ถ้ายังไม่มี) หรือ None
+    global _notif_reaper
+
+    with _notif_hubs_lock:
+        hub = _notif_hubs.get(key)
+        if hub is not None and hub["watch"] is not None and not hub["watch"].is_active:
+            # listener ตาย (network / permission) → ติดใหม่
+            _notif_hubs.pop(key)
+            hub = None
+
+        if hub is None:
+            if len(_notif_hubs) >= NOTIF_STREAM_MAX_SHOPS:
+                return None
+
+            hub = {
+                "watch": None,
+                "ready": threading.Event(),
+                "docs": {},
+                "tombstones": OrderedDict(),
+                "complete_since": None,
+                "subscribers": set(),
+                "idle_since": time.monotonic()
+            }
+            _notif_hubs[key] = hub
+            attach = True
+        else:
+            hub["idle_since"] = time.monotonic()
+            attach = False
+
+        if _notif_reaper is None:
+            _notif_reaper = threading.Thread(target=_reap_notif_hubs, daemon=True)
+            _notif_reaper.start()
+
+    if attach:
+        try:
+            hub["watch"] = _notif_query(*key).on_snapshot(
+                lambda col_snapshot, changes, read_time:
+                    _on_notif_snapshot(key, col_snapshot, changes, read_time)
+            )
+        except Exception:
+            log("🔥 ERROR notification hub:", traceback.format_exc())
+            with _notif_hubs_lock:
+                _notif_hubs.pop(key, None)
+            return None
+
+    if not hub["ready"].wait(NOTIF_STREAM_WAIT):
+        return None
+    return hub
+
+
+def streaming_supported(environ):
+    # gthread / dev server → wsgi.multithread, gevent / eventlet → socket ถูก monkey patch
+    # sync worker → stream 1 อันกิน worker ทั้งตัวไปถึง NOTIF_STREAM_MAX_AGE
+    if environ.get("wsgi.multithread"):
+        return True
+
+    gevent_monkey = sys.modules.get("gevent.monkey")
+    if gevent_monkey is not None and gevent_monkey.is_module_patched("socket"):
+        return True
+
+    eventlet_patcher = sys.modules.get("eventlet.patcher")
+    return eventlet_patcher is not None and eventlet_patcher.is_monkey_patched("socket")
+
+
+def _sse(event):
+    payload = app.json.dumps({k: v for k, v in event.items() if k != "eventId"})
+    return f"id: {event['eventId']}\nevent: {event['type']}\ndata: {payload}\n\n"
+
+
+def notif_stream(hub, last_event_id):
+    q = queue.Queue(NOTIF_STREAM_QUEUE)
+
+    with _notif_hubs_lock:
+        # backlog + subscribe ใต้ lock เดียว → ไม่ตกหล่น ไม่ซ้ำ
+        snapshot = last_event_id is None or last_event_id < hub["complete_since"]
+        backlog = sorted(
+            (e for e in hub["docs"].values()
+             if snapshot or e["eventId"] > last_event_id),
+            key=lambda e: e["eventId"]
+        )
+        latest = max([hub["complete_since"]] + [e["eventId"] for e in backlog])
+        hub["subscribers"].add(q)
+
+    started = time.monotonic()
+    try:
+        # ให้ EventSource รอ 3 วินาทีก่อน reconnect
+        yield "retry: 3000\n\n"
+
+        if snapshot:
+            # เปิดครั้งแรก / resume ไม่ได้ → ส่งรายการปัจจุบันก้อนเดียว (ใหม่ → เก่า) ให้ client แทนที่ทั้งหมด
+            items = [e["data"] for e in reversed(backlog) if e["type"] != "removed"]
+            yield f"id: {latest}\nevent: snapshot\ndata: {app.json.dumps(items)}\n\n"
+        else:
+            for event in backlog:
+                yield _sse(event)
+
+        while time.monotonic() - started < NOTIF_STREAM_MAX_AGE:
+            try:
+                event = q.get(timeout=NOTIF_STREAM_HEARTBEAT)
+            except queue.Empty:
+                # กัน proxy ตัด connection ที่เงียบ
+                yield ": ping\n\n"
+                continue
+
+            if event is None:
+                return
+            yield _sse(event)
+    finally:
+        with _notif_hubs_lock:
+            hub["subscribers"].discard(q)
+            if not hub["subscribers"]:
+                hub["idle_since"] = time.monotonic()
+
+
+@app.route("/notifications/stream", methods=["GET"])
+def stream_notifications():
+    shopname = request.args.get("shopname")
+    kind = request.args.get("kind", "notifications")
+
+    if not shopname or kind not in NOTIF_STREAM_KINDS:
+        return jsonify({"error": "Missing shopname or invalid kind"}), 400
+
+    if not streaming_supported(request.environ):
+        return jsonify({"error": "Streaming needs a threaded or async worker, poll instead"}), 503
+
+    # EventSource ส่ง Last-Event-ID เองตอน reconnect, ครั้งแรกส่งทาง query ได้
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        return jsonify({"error": "Invalid Last-Event-ID"}), 400
+
+    hub = notif_hub((shopname, kind))
+    if hub is None:
+        # เกินจำนวน listener / ติดไม่สำเร็จ → client กลับไป poll
+        return jsonify({"error": "Stream unavailable"}), 503
+
+    return Response(
+        stream_with_context(notif_stream(hub, last_event_id)),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+
+@app.route("/notifications/stream_stats", methods=["GET"])
+def get_notif_stream_stats():
+    with _notif_hubs_lock:
+        return jsonify({
+            "shops": len(_notif_hubs),
+            "subscribers": sum(len(hub["subscribers"]) for hub in _notif_hubs.values()),
+            "max_shops": NOTIF_STREAM_MAX_SHOPS
+        })
+
+
+# ---------------- Unread notification counter -------------------
+# {shopname}/system/counters/notifications → {"unread": n, "recountedAt": ts}
+# ร้านเก่า: counter ถูกสร้างจาก Increment ก่อนเคยนับ (ไม่มี recountedAt) → นับใหม่ครั้งแรกใน transaction
+# confirm_order +1 (batch เดียวกับ notification), mark read -1 (เฉพาะที่ยัง unread จริง)
+# badge อ่านเอกสารเดียว ไม่ต้องอ่าน notifications ทั้งหมด
+BULK_MARK_READ_MAX = int(os.environ.get("BULK_MARK_READ_MAX", "5000"))
+BULK_MARK_READ_RETRIES = 3
+
+
+def notifications_ref(shopname):
+    return (
+        db.collection(shopname)
+          .document("system")
+          .collection("notifications")
+    )
+
+
+def unread_counter_ref(shopname):
+    return (
+        db.collection(shopname)
+          .document("system")
+          .collection("counters")
+          .document("notifications")
+    )
+
+
+@counted_transaction
+def _recount_unread_txn(transaction, shopname, force, loader):
+    counter_ref = unread_counter_ref(shopname)
+
+    # อ่าน counter ใน transaction → confirm / mark read ที่ Increment พร้อมกันต้องรอหรือ retry
+    counter = counter_ref.get(transaction=transaction)
+    loader.note(1, 1)
+    current = counter.to_dict() if counter.exists else {}
+
+    # มีคนนับไปแล้วระหว่างรอ → ใช้ค่าเดิม
+    if not force and current.get("recountedAt") and current.get("unread", 0) >= 0:
+        return current["unread"]
+
+    # count aggregation → ตั้งค่า counter ใหม่ (ร้านเก่าที่ยังไม่เคยนับ / ค่าเพี้ยน)
+    unread = count_items(
+        notifications_ref(shopname).where("status", "==", "unread"), transaction
+    )
+    loader.note(1, 1)
+
+    transaction.set(counter_ref, {
+        "unread": unread,
+        "recountedAt": firestore.SERVER_TIMESTAMP
+    })
+    loader.note(writes=1)
+    return unread
+
+
+def recount_unread(shopname, force=False):
+    docs = request_docs()
+    with docs.rpc(rpcs=0):
+        unread = _recount_unread_txn(db.transaction(), shopname, force, docs)
+    docs.forget(unread_counter_ref(shopname))
+    return unread
+
+
+def _mark_read_chunk(shopname, refs):
+    # อ่าน status แล้ว update เฉพาะที่ยัง unread + ลด counter ใน batch เดียว
+    # last_update_time → ถ้ามีคนแก้ระหว่างนั้น ทั้ง batch ล้ม แล้วอ่านใหม่ (counter ไม่ลดซ้ำ)
+    docs = request_docs()
+
+    for _ in range(BULK_MARK_READ_RETRIES):
+        snapshots = docs.get_many(refs, ["status"])
+
+        unread = [
+            doc for doc in snapshots
+            if doc.exists and doc.to_dict().get("status") == "unread"
+        ]
+        if not unread:
+            return 0
+
+        batch = db.batch()
+        for doc in unread:
+            batch.update(
+                doc.reference,
+                {"status": "read", "readAt": firestore.SERVER_TIMESTAMP},
+                option=db.write_option(last_update_time=doc.update_time)
+            )
+        batch.set(unread_counter_ref(shopname), {
+            "unread": firestore.Increment(-len(unread))
+        }, merge=True)
+
+        try:
+            with docs.rpc(writes=len(unread) + 1):
+                batch.commit()
+            return len(unread)
+        except FailedPrecondition:
+            docs.forget(*refs)
+            continue
+
+    raise RuntimeError("Notifications changed concurrently, please retry")
+
+
+#---------------------ตั้งเมื่ออ่าน order ให้  "status": "read" ----------------
+@app.route("/mark_notification_read", methods=["POST"])
+def mark_notification_read():
+    try:
+        data = request.get_json()
+        shopname = data.get("shopname")
+        notificationId = data.get("notificationId")
+
+        if not shopname or not notificationId:
+            return jsonify({"status": "error"}), 400
+
+        notif_ref = notifications_ref(shopname).document(notificationId)
+
+        if not request_docs().get(notif_ref, ["status"]).exists:
+            return jsonify({"error": "Notification not found"}), 404
+
+        _mark_read_chunk(shopname, [notif_ref])
+
+        return jsonify({"status": "success"})
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/mark_notifications_read", methods=["POST"])
+def mark_notifications_read():
+    # {"shopname": ..., "ids": [...]}  หรือ  {"shopname": ..., "before": "<ISO createdAt>"}
+    try:
+        data = request.get_json()
+        shopname = data.get("shopname")
+        ids = data.get("ids")
+        before = data.get("before")
+
+        if not shopname or (ids is None and not before):
+            return jsonify({"error": "Missing shopname and ids or before"}), 400
+
+        chunk_size = FIRESTORE_BATCH_LIMIT - 1   # + counter
+        marked = 0
+        remaining = False
+
+        if ids is not None:
+            if not isinstance(ids, list) or not all(isinstance(i, str) and i for i in ids):
+                return jsonify({"error": "ids must be a list of notification ids"}), 400
+            if len(ids) > BULK_MARK_READ_MAX:
+                return jsonify({"error": f"Too many ids (max {BULK_MARK_READ_MAX})"}), 400
+
+            collection_ref = notifications_ref(shopname)
+            refs = [collection_ref.document(i) for i in dict.fromkeys(ids)]
+            for n in range(0, len(refs), chunk_size):
+                marked += _mark_read_chunk(shopname, refs[n:n + chunk_size])
+
+        else:
+            try:
+                before = datetime.fromisoformat(before)
+            except (TypeError, ValueError):
+                return jsonify({"error": "Invalid before"}), 400
+
+            # ต้องมี composite index (status, createdAt)
+            # ที่ mark แล้วหลุดจาก query → อ่านหน้าแรกซ้ำจนหมด
+            query = (
+                notifications_ref(shopname)
+                  .where("status", "==", "unread")
+                  .where("createdAt", "<=", before)
+                  .select([])
+                  .limit(chunk_size)
+            )
+            while True:
+                docs = request_docs()
+                with docs.rpc() as call:
+                    refs = [doc.reference for doc in query.stream()]
+                    call["reads"] = max(len(refs), 1)
+                if not refs:
+                    break
+
+                marked += _mark_read_chunk(shopname, refs)
+                if marked >= BULK_MARK_READ_MAX:
+                    remaining = True
+                    break
+
+        return jsonify({
+            "status": "success",
+            "marked": marked,
+            "remaining": remaining
+        })
 
     except Exception as e:
-        print("🔥 ERROR get_notification_modes:", e)
+        log("🔥 ERROR mark_notifications_read:", e)
         return jsonify({"error": str(e)}), 500
 
 
-#---------------------ตั้งเมื่ออ่าน order ให้  "status": "read" ----------------
-@app.route("/mark_notification_read", methods=["POST"])
-def mark_notification_read():
-    try:
-        data = request.get_json()
-        shopname = data.get("shopname")
-        notificationId = data.get("notificationId")
+@app.route("/notifications/unread_count", methods=["GET"])
+def get_unread_count():
+    try:
+        shopname = request.args.get("shopname")
+        if not shopname:
+            return jsonify({"error": "Missing shopname"}), 400
+
+        counter = request_docs().get(unread_counter_ref(shopname))
+        current = counter.to_dict() if counter.exists else {}
+        unread = current.get("unread")
+
+        # ยังไม่เคยนับ (ไม่มี recountedAt) / ติดลบ / ขอ recount → นับใหม่
+        force = request.args.get("recount") == "1"
+        if force or not current.get("recountedAt") or unread is None or unread < 0:
+            unread = recount_unread(shopname, force)
+
+        return jsonify({"status": "success", "unread": unread})
+
+    except Exception as e:
+        log("🔥 ERROR unread_count:", e)
+        return jsonify({"error": str(e)}), 500
+
+#------------------------------------
+# ---------------- Active order cache -------------------
+# (shopname, customerName) → activeOrderId ที่เพิ่งเห็น
+# สด (< ACTIVE_ORDER_TTL) → save_order ข้ามการอ่าน customer ไปเลย
+# เก่ากว่านั้น → ใช้เป็น "เดา" อ่าน customer + order ใน get_all ครั้งเดียว
+# เดาผิด (order ไม่ใช่ draft / customer ชี้ order อื่น) → อ่านใหม่ตามจริง
+ACTIVE_ORDER_TTL = float(os.environ.get("ACTIVE_ORDER_TTL", "30"))
+ACTIVE_ORDER_MAX_ENTRIES = int(os.environ.get("ACTIVE_ORDER_MAX_ENTRIES", "10000"))
+
+_active_orders = OrderedDict()
+_active_orders_lock = threading.Lock()
+
+
+def get_active_order_hint(shopname, customer_name):
+    # คืน (order_id, สดไหม) หรือ (None, False)
+    with _active_orders_lock:
+        entry = _active_orders.get((shopname, customer_name))
+        if entry is None:
+            return None, False
+        order_id, cached_at = entry
+        return order_id, time.monotonic() - cached_at < ACTIVE_ORDER_TTL
+
+
+def set_active_order(shopname, customer_name, order_id):
+    key = (shopname, customer_name)
+    with _active_orders_lock:
+        if order_id:
+            _active_orders[key] = (order_id, time.monotonic())
+            _active_orders.move_to_end(key)
+            while len(_active_orders) > ACTIVE_ORDER_MAX_ENTRIES:
+                _active_orders.popitem(last=False)
+        else:
+            _active_orders.pop(key, None)
+
+
+def count_items(items_ref, transaction=None):
+    # count aggregation → คิดค่าอ่านตาม index entry ไม่ต้องดึงเอกสาร
+    result = items_ref.count(alias="n").get(transaction=transaction)
+    return int(result[0][0].value)
+
+
+def new_order_item(data):
+    return {
+        "productname": data.get("productname"),
+        "numberproduct": data.get("numberproduct", 0),
+        "image_url": data.get("image_url", ""),
+        "into_unit": data.get("into_unit", ""),
+        "priceproduct": data.get("priceproduct", 0),
+        "order_type": data.get("order_type", ""),
+        "prepare": "Not prepared",
+        "created_at": firestore.SERVER_TIMESTAMP
+    }
+
+
+@counted_transaction
+def _save_order_txn(transaction, customer_ref, hint, hint_fresh, item, loader):
+    orders_ref = customer_ref.collection("orders")
+
+    if hint and hint_fresh:
+        # ⚡ ทางด่วน: รู้ activeOrderId แล้ว → อ่านแค่ order
+        order_doc = orders_ref.document(hint).get(transaction=transaction)
+        loader.note(1, 1)
+        customer_doc = None
+    elif hint:
+        # อ่าน customer + order ที่เดาไว้ใน RPC เดียว
+        docs = {
+            doc.reference.path: doc
+            for doc in db.get_all(
+                [customer_ref, orders_ref.document(hint)], transaction=transaction
+            )
+        }
+        loader.note(1, 2)
+        customer_doc = docs[customer_ref.path]
+        order_doc = docs[orders_ref.document(hint).path]
+    else:
+        customer_doc = None
+        order_doc = None
+
+    fast_ok = (
+        order_doc is not None and order_doc.exists
+        and order_doc.to_dict().get("status") == "draft"
+    )
+
+    if customer_doc is None and not fast_ok:
+        customer_doc = customer_ref.get(transaction=transaction)
+        loader.note(1, 1)
+
+    if customer_doc is not None:
+        if not customer_doc.exists:
+            return 404, "Customer not found", None
+
+        active_order_id = customer_doc.to_dict().get("activeOrderId")
+        if not active_order_id:
+            return 400, "No active order", None
+
+        if active_order_id != hint:
+            order_doc = orders_ref.document(active_order_id).get(transaction=transaction)
+            loader.note(1, 1)
+    else:
+        active_order_id = hint
+
+    if not order_doc.exists:
+        return 404, "Order not found", active_order_id
 
-        if not shopname or not notificationId:
-            return jsonify({"status": "error"}), 400
+    if order_doc.to_dict().get("status") != "draft":
+        return 400, "Order already confirmed", active_order_id
 
-        notif_ref = (
-            db.collection(shopname)
-              .document("system")
-              .collection("notifications")
-              .document(notificationId)
-        )
+    # ===============================
+    # เพิ่มสินค้า → items (สร้างใหม่ทุกครั้ง) + เพิ่มจำนวน Preorder ใน commit เดียว
+    # ===============================
+    order_ref = orders_ref.document(active_order_id)
 
-        notif_ref.update({
-            "status": "read"
-        })
+    # item_count เพิ่มทีละ 1 (order เก่าที่ยังไม่มี field → นับครั้งเดียวด้วย count aggregation)
+    if "item_count" in order_doc.to_dict():
+        item_count = firestore.Increment(1)
+    else:
+        item_count = count_items(order_ref.collection("items"), transaction) + 1
+        loader.note(1, 1)
+
+    transaction.set(order_ref.collection("items").document(), item)   # 🔥 auto id → item ใหม่ทุกครั้ง
+    transaction.update(order_ref, {
+        "Preorder": firestore.Increment(1),
+        "item_count": item_count,
+        "updatedAt": firestore.SERVER_TIMESTAMP
+    })
+    loader.note(writes=2)
 
-        return jsonify({"status": "success"})
+    return 200, None, active_order_id
 
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
 
-#------------------------------------
 @app.route("/save_order", methods=["POST"])
+@idempotent
 def save_order():
     try:
         data = request.get_json()
+        docs = request_docs()
 
         # ===============================
         # 1️⃣ รับค่าจาก MAUI
@@ -777,71 +3574,26 @@ def save_order():
               .document(customerName)
         )
 
-        customer_doc = customer_ref.get()
-        if not customer_doc.exists:
-            return jsonify({
-                "status": "error",
-                "message": "Customer not found"
-            }), 404
-
-        customer_data = customer_doc.to_dict()
-        active_order_id = customer_data.get("activeOrderId")
-
-        if not active_order_id:
-            return jsonify({
-                "status": "error",
-                "message": "No active order"
-            }), 400
+        item = new_order_item(data)
 
         # ===============================
-        # 3️⃣ อ้างอิง order ปัจจุบัน
+        # 3️⃣ อ่าน customer/order + เขียน item + Preorder ใน transaction เดียว
         # ===============================
-        order_ref = (
-            customer_ref
-              .collection("orders")
-              .document(active_order_id)
-        )
+        hint, hint_fresh = get_active_order_hint(shopname, customerName)
 
-        order_doc = order_ref.get()
-        if not order_doc.exists:
-            return jsonify({
-                "status": "error",
-                "message": "Order not found"
-            }), 404
+        with docs.rpc(rpcs=0):
+            status_code, message, active_order_id = _save_order_txn(
+                db.transaction(), customer_ref, hint, hint_fresh, item, docs
+            )
+
+        # สำเร็จ → จำ activeOrderId ไว้, ไม่สำเร็จ → ลืม (ครั้งหน้าอ่านใหม่)
+        set_active_order(shopname, customerName, active_order_id if status_code == 200 else None)
 
-        if order_doc.to_dict().get("status") != "draft":
+        if status_code != 200:
             return jsonify({
                 "status": "error",
-                "message": "Order already confirmed"
-            }), 400
-
-        # ===============================
-        # 4️⃣ เพิ่มสินค้า → items (สร้างใหม่ทุกครั้ง)
-        # ===============================
-        item_ref = (
-            order_ref
-              .collection("items")
-              .document()  # 🔥 auto id → item ใหม่ทุกครั้ง
-        )
-
-        item_ref.set({
-            "productname": productname,
-            "numberproduct": data.get("numberproduct", 0),
-            "image_url": data.get("image_url", ""),
-            "into_unit": data.get("into_unit", ""),
-            "priceproduct": data.get("priceproduct", 0),
-            "order_type": data.get("order_type", ""),
-            "prepare": "Not prepared",
-            "created_at": firestore.SERVER_TIMESTAMP
-        })
-
-        # ===============================
-        # 5️⃣ เพิ่มจำนวน Preorder
-        # ===============================
-        order_ref.update({
-            "Preorder": firestore.Increment(1),
-            "updatedAt": firestore.SERVER_TIMESTAMP
-        })
+                "message": message
+            }), status_code
 
         return jsonify({
             "status": "success",
@@ -849,7 +3601,7 @@ def save_order():
         })
 
     except Exception as e:
-        print("🔥 ERROR save_order:", e)
+        log("🔥 ERROR save_order:", e)
         return jsonify({
             "status": "error",
             "message": str(e)
@@ -896,24 +3648,27 @@ def update_save_order():
         )
 
         # 🔎 ตรวจว่ามี item จริง
-        if not item_ref.get().exists:
+        docs = request_docs()
+        if not docs.get(item_ref, ["numberproduct"]).exists:
             return jsonify({
                 "status": "error",
                 "message": "Item not found"
             }), 404
 
         # ✅ update จำนวน
-        item_ref.update({
-            "numberproduct": numberproduct,
-            "updated_at": firestore.SERVER_TIMESTAMP
-        })
+        with docs.rpc(writes=1):
+            item_ref.update({
+                "numberproduct": numberproduct,
+                "updated_at": firestore.SERVER_TIMESTAMP
+            })
+        docs.forget(item_ref)
 
         return jsonify({
             "status": "success"
         })
 
     except Exception as e:
-        print("🔥 ERROR update_save_order:", e)
+        log("🔥 ERROR update_save_order:", e)
         return jsonify({
             "status": "error",
             "message": str(e)
@@ -1001,35 +3756,99 @@ def get_orders():
 
         items = []
 
-        docs = list(items_ref.stream())
-        print(f"🔥 FOUND ITEMS: {len(docs)}")
+        # 📄 page_size / cursor → อ่านเฉพาะหน้านั้น
+        cursor = request.args.get("cursor")
+        next_cursor = None
+        try:
+            page_size = parse_page_size(request.args.get("page_size"))
+            # ✂️ fields=productname,numberproduct → Firestore select() อ่านเฉพาะ field ที่ขอ
+            fields = parse_fields(request.args.get("fields"))
+
+            if page_size or cursor:
+                docs, next_cursor = page_query(
+                    items_ref, cursor, page_size or PAGE_SIZE_MAX, fields
+                )
+            elif fields:
+                docs = list(items_ref.select(fields).stream())
+            else:
+                docs = list(items_ref.stream())
+        except ValueError as e:
+            return jsonify({
+                "status": "error",
+                "message": str(e)
+            }), 400
+
+        log(f"🔥 FOUND ITEMS: {len(docs)}")
 
         for doc in docs:
             data = doc.to_dict()
             data["itemId"] = doc.id   # 🔥 สำคัญ ใช้ลบ / แก้ไข item
 
             # แปลง Firestore Timestamp
-            created = data.get("created_at")
-            if created:
-                data["created_at"] = created.isoformat()
-            else:
-                data["created_at"] = None
+            if not fields or "created_at" in fields:
+                created = data.get("created_at")
+                if created:
+                    data["created_at"] = created.isoformat()
+                else:
+                    data["created_at"] = None
 
             items.append(data)
 
-        return jsonify({
+        response = {
             "status": "success",
             "items": items
-        })
+        }
+        if page_size or cursor:
+            response["next_cursor"] = next_cursor
+
+        return jsonify(response)
 
     except Exception as e:
-        print("🔥 ERROR get_orders:", e)
+        log("🔥 ERROR get_orders:", e)
         return jsonify({
             "status": "error",
             "message": str(e)
         }), 500
 
 #----------------------------------------------
+@counted_transaction
+def _delete_order_item_txn(transaction, order_ref, item_ref, loader):
+    # อ่าน order + item ใน RPC เดียว (ไม่ stream items ที่เหลือมานับ)
+    docs = {
+        doc.reference.path: doc
+        for doc in db.get_all([order_ref, item_ref], transaction=transaction)
+    }
+    loader.note(1, 2)
+    order_doc = docs[order_ref.path]
+    if not order_doc.exists:
+        return 404, "Order not found", None
+
+    if not docs[item_ref.path].exists:
+        return 404, "Item not found", None
+
+    order_data = order_doc.to_dict()
+
+    # 🔥 ลด Preorder ลง 1 (ไม่ให้ติดลบ) — อยู่ใน transaction จึงไม่ชนกับ save_order
+    new_preorder = max(order_data.get("Preorder", 0) - 1, 0)
+
+    # 🔥 item_count ที่เหลือ (order เก่าที่ยังไม่มี field → count aggregation ครั้งเดียว)
+    if "item_count" in order_data:
+        item_count = max(order_data["item_count"] - 1, 0)
+    else:
+        item_count = max(count_items(order_ref.collection("items"), transaction) - 1, 0)
+        loader.note(1, 1)
+
+    transaction.delete(item_ref)
+    transaction.set(order_ref, {
+        "Preorder": new_preorder,
+        "item_count": item_count,
+        "updated_at": firestore.SERVER_TIMESTAMP
+    }, merge=True)
+    loader.note(writes=2)
+
+    return 200, None, (new_preorder, item_count)
+
+
 @app.route("/delete_order", methods=["POST"])
 def delete_order():
     try:
@@ -1060,43 +3879,26 @@ def delete_order():
               .document(order_id)
         )
 
-        order_doc = order_ref.get()
-        if not order_doc.exists:
-            return jsonify({
-                "status": "error",
-                "message": "Order not found"
-            }), 404
-
         # ===============================
         # item ref
         # /items/{itemId}
         # ===============================
         item_ref = order_ref.collection("items").document(item_id)
 
-        if not item_ref.get().exists:
+        # 🔥 ลบ item + update order (Preorder / item_count) ใน commit เดียว
+        docs = request_docs()
+        with docs.rpc(rpcs=0):
+            status_code, message, counts = _delete_order_item_txn(
+                db.transaction(), order_ref, item_ref, docs
+            )
+
+        if status_code != 200:
             return jsonify({
                 "status": "error",
-                "message": "Item not found"
-            }), 404
-
-        # 🔥 1. ลบ item
-        item_ref.delete()
-
-        # 🔥 2. ลด Preorder ลง 1 (ไม่ให้ติดลบ)
-        order_data = order_doc.to_dict()
-        current_preorder = order_data.get("Preorder", 0)
-        new_preorder = max(current_preorder - 1, 0)
-
-        # 🔥 3. นับ item ที่เหลือ (optional แต่แนะนำ)
-        items_ref = order_ref.collection("items")
-        item_count = len(list(items_ref.stream()))
+                "message": message
+            }), status_code
 
-        # 🔥 4. update order document
-        order_ref.set({
-            "Preorder": new_preorder,
-            "item_count": item_count,
-            "updated_at": firestore.SERVER_TIMESTAMP
-        }, merge=True)
+        new_preorder, item_count = counts
 
         return jsonify({
             "status": "success",
@@ -1106,7 +3908,182 @@ def delete_order():
         })
 
     except Exception as e:
-        print("🔥 ERROR delete_order:", e)
+        log("🔥 ERROR delete_order:", e)
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
+
+#------------------ sync ตะกร้าทั้งก้อน ----------------------------
+# body: {"shopname", "customerName", "orderId"?, "mutations": [
+#   {"op": "add", "productname": ..., "numberproduct": ..., ...},
+#   {"op": "update", "itemId": ..., "numberproduct": ...},
+#   {"op": "delete", "itemId": ...}
+# ]}
+# อ่าน order + items ครั้งเดียว, เขียนทุกอย่าง + Preorder/item_count ใน commit เดียว (transaction)
+CART_SYNC_MAX_MUTATIONS = 400
+
+
+def _cart_item_json(item_id, item):
+    item = dict(item)
+    item["itemId"] = item_id
+    created = item.get("created_at")
+    # item ใหม่ยังเป็น SERVER_TIMESTAMP (ยังไม่รู้เวลาจริง)
+    item["created_at"] = created.isoformat() if isinstance(created, datetime) else None
+    updated = item.pop("updated_at", None)
+    if isinstance(updated, datetime):
+        item["updated_at"] = updated.isoformat()
+    return item
+
+
+@counted_transaction
+def _sync_cart_txn(transaction, order_ref, mutations, loader):
+    order_doc = order_ref.get(transaction=transaction)
+    loader.note(1, 1)
+    if not order_doc.exists:
+        return 404, "Order not found", None
+    if order_doc.to_dict().get("status") != "draft":
+        return 400, "Order already confirmed", None
+
+    items_ref = order_ref.collection("items")
+    items = {doc.id: doc.to_dict() for doc in items_ref.stream(transaction=transaction)}
+    # query ที่ว่างก็คิด 1 read
+    loader.note(1, max(len(items), 1))
+
+    results = []
+    adds = deletes = 0
+
+    for i, m in enumerate(mutations):
+        op = m.get("op") if isinstance(m, dict) else None
+        item_id = m.get("itemId") if op else None
+        if not isinstance(item_id, str):
+            item_id = None
+
+        if op == "add":
+            if not m.get("productname"):
+                results.append({"index": i, "status": "error", "message": "Missing productname"})
+                continue
+            item_ref = items_ref.document()
+            item = new_order_item(m)
+            transaction.set(item_ref, item)
+            items[item_ref.id] = item
+            adds += 1
+            results.append({"index": i, "status": "success", "itemId": item_ref.id})
+
+        elif op == "update":
+            numberproduct = m.get("numberproduct")
+            if item_id not in items:
+                results.append({"index": i, "status": "skipped", "message": "Item not found"})
+                continue
+            if not isinstance(numberproduct, (int, float)) or numberproduct < 0:
+                results.append({"index": i, "status": "error", "message": "Invalid numberproduct"})
+                continue
+            fields = {"numberproduct": numberproduct, "updated_at": firestore.SERVER_TIMESTAMP}
+            transaction.update(items_ref.document(item_id), fields)
+            items[item_id] = {**items[item_id], **fields}
+            results.append({"index": i, "status": "success", "itemId": item_id})
+
+        elif op == "delete":
+            if item_id not in items:
+                results.append({"index": i, "status": "skipped", "message": "Item not found"})
+                continue
+            transaction.delete(items_ref.document(item_id))
+            del items[item_id]
+            deletes += 1
+            results.append({"index": i, "status": "success", "itemId": item_id})
+
+        else:
+            results.append({"index": i, "status": "error", "message": "Invalid op"})
+
+    # Preorder นับแบบเดียวกับ save_order (+1) / delete_order (-1, ไม่ติดลบ)
+    preorder = max(order_doc.to_dict().get("Preorder", 0) + adds - deletes, 0)
+    transaction.update(order_ref, {
+        "Preorder": preorder,
+        "item_count": len(items),
+        "updated_at": firestore.SERVER_TIMESTAMP
+    })
+    # mutation ที่สำเร็จ = 1 write ต่อรายการ + order
+    loader.note(writes=sum(r["status"] == "success" for r in results) + 1)
+
+    return 200, None, {
+        "Preorder": preorder,
+        "item_count": len(items),
+        "items": [_cart_item_json(item_id, item) for item_id, item in items.items()],
+        "results": results
+    }
+
+
+@app.route("/sync_cart", methods=["POST"])
+def sync_cart():
+    try:
+        data = request.get_json()
+        docs = request_docs()
+
+        shopname = data.get("shopname")
+        customer_name = data.get("customerName")
+        order_id = data.get("orderId")
+        mutations = data.get("mutations")
+
+        if not shopname or not customer_name or not isinstance(mutations, list):
+            return jsonify({
+                "status": "error",
+                "message": "Missing shopname, customerName or mutations"
+            }), 400
+
+        if len(mutations) > CART_SYNC_MAX_MUTATIONS:
+            return jsonify({
+                "status": "error",
+                "message": f"Too many mutations (max {CART_SYNC_MAX_MUTATIONS})"
+            }), 400
+
+        customer_ref = (
+            db.collection(shopname)
+              .document("customer")
+              .collection("customers")
+              .document(customer_name)
+        )
+
+        # ไม่ส่ง orderId → ใช้ activeOrderId (cache หรืออ่าน customer)
+        if not order_id:
+            order_id, fresh = get_active_order_hint(shopname, customer_name)
+            if not order_id or not fresh:
+                customer_doc = docs.get(customer_ref, ["activeOrderId"])
+                if not customer_doc.exists:
+                    return jsonify({
+                        "status": "error",
+                        "message": "Customer not found"
+                    }), 404
+                order_id = customer_doc.to_dict().get("activeOrderId")
+                if not order_id:
+                    return jsonify({
+                        "status": "error",
+                        "message": "No active order"
+                    }), 400
+
+        order_ref = customer_ref.collection("orders").document(order_id)
+
+        with docs.rpc(rpcs=0):
+            status_code, message, cart = _sync_cart_txn(
+                db.transaction(), order_ref, mutations, docs
+            )
+
+        if status_code != 200:
+            if not data.get("orderId"):
+                set_active_order(shopname, customer_name, None)
+            return jsonify({
+                "status": "error",
+                "message": message
+            }), status_code
+
+        return jsonify({
+            "status": "success",
+            "orderId": order_id,
+            **cart
+        })
+
+    except Exception as e:
+        log("🔥 ERROR sync_cart:", e)
         return jsonify({
             "status": "error",
             "message": str(e)
@@ -1120,22 +4097,12 @@ def get_modes():
 
     # folder แม่
     prefix = "modeproduct/"
-    blobs = bucket.list_blobs(prefix=prefix)
-
-    folder_names = set()
-
-    for blob in blobs:
-        # ตัด "modeproduct/" ออก
-        name = blob.name.replace(prefix, "")
 
-        # name = "สินค้าขายดี/โค้ก.jpg"
-        if "/" in name:
-            folder = name.split("/")[0]
-            if folder:
-                folder_names.add(folder)
+    # name = "สินค้าขายดี/โค้ก.jpg" → folders["สินค้าขายดี"]
+    folder_names = get_bucket_index(prefix)["folders"].keys()
 
     # ส่งกลับ List<string> ของ folder ลูกทั้งหมด
-    return jsonify(sorted(list(folder_names)))
+    return jsonify(sorted(folder_names))
     #--------------------------------
 @app.route("/get_modesonline", methods=["GET"])
 def get_modesonline():
@@ -1147,26 +4114,73 @@ def get_modesonline():
     # folder แม่: shop1/
     prefix = f"{shopname}/"
 
-    blobs = bucket.list_blobs(prefix=prefix)
-    folder_names = set()
-
-    for blob in blobs:
-        # เอา prefix ออก
-        name = blob.name.replace(prefix, "")
-        # ตัวอย่าง: "เครื่องปรุงรส/ซอส/ซอสพริก.jpg"
-        if "/" in name:
-            folder = name.split("/")[0]
-            if folder:
-                folder_names.add(folder)
+    # ตัวอย่าง: "เครื่องปรุงรส/ซอส/ซอสพริก.jpg" → folders["เครื่องปรุงรส"]
+    folder_names = get_bucket_index(prefix)["folders"].keys()
 
     # ส่งกลับ List<string> ของ folder ลูกทั้งหมด
-    return jsonify(sorted(list(folder_names)))
+    return jsonify(sorted(folder_names))
 
 
 #---------------------------------------------
  
 
 
+@counted_transaction
+def _get_preorder_txn(transaction, customer_ref, hint, loader):
+    orders_ref = customer_ref.collection("orders")
+
+    # 1️⃣ อ่าน customer (+ order ที่ cache จำไว้) ใน RPC เดียว, เอาแค่ field ที่ใช้
+    refs = [customer_ref] + ([orders_ref.document(hint)] if hint else [])
+    docs = {
+        doc.reference.path: doc
+        for doc in db.get_all(
+            refs, field_paths=["activeOrderId", "Preorder"], transaction=transaction
+        )
+    }
+    loader.note(1, len(refs))
+
+    customer_doc = docs[customer_ref.path]
+    active_order_id = customer_doc.to_dict().get("activeOrderId") if customer_doc.exists else ""
+
+    # 2️⃣ เช็คว่าต้องสร้าง order ใหม่ไหม
+    order_doc = None
+    if active_order_id:
+        if active_order_id == hint:
+            order_doc = docs[orders_ref.document(hint).path]
+        else:
+            order_doc = orders_ref.document(active_order_id).get(
+                field_paths=["Preorder"], transaction=transaction
+            )
+            loader.note(1, 1)
+
+    if order_doc is not None and order_doc.exists:
+        return active_order_id, order_doc.to_dict().get("Preorder", 0)
+
+    # 3️⃣ สร้าง customer (ถ้ายังไม่มี) + order ใหม่ พร้อมกัน
+    #    สองเครื่องเปิดพร้อมกัน → transaction ที่ช้ากว่าถูก retry แล้วเห็น order ของอีกฝั่ง
+    timestamp_id = str(int(time.time() * 1000))
+
+    transaction.set(orders_ref.document(timestamp_id), {
+        "status": "draft",
+        "Preorder": 0,
+        "item_count": 0,
+        "createdAt": datetime.utcnow()
+    })
+
+    if customer_doc.exists:
+        transaction.update(customer_ref, {
+            "activeOrderId": timestamp_id
+        })
+    else:
+        transaction.set(customer_ref, {
+            "activeOrderId": timestamp_id,
+            "createdAt": datetime.utcnow()
+        }, merge=True)
+    loader.note(writes=2)
+
+    return timestamp_id, 0
+
+
 @app.route("/get_preorder", methods=["GET"])
 def get_preorder():
     customerName = request.args.get("customerName")
@@ -1185,69 +4199,20 @@ def get_preorder():
           .document(customerName)
     )
 
-    customer_doc = customer_ref.get()
-
-    # 1️⃣ ถ้ายังไม่มี customer → สร้าง
-    if not customer_doc.exists:
-        customer_ref.set({
-            "activeOrderId": "",
-            "createdAt": datetime.utcnow()
-        }, merge=True)
-
-        customer_doc = customer_ref.get()
-
-    customer_data = customer_doc.to_dict()
-    active_order_id = customer_data.get("activeOrderId")
-
-    # 2️⃣ เช็คว่าต้องสร้าง order ใหม่ไหม
-    need_new_order = False
-
-    if not active_order_id or active_order_id == "":
-        need_new_order = True
-    else:
-        check_ref = (
-            customer_ref
-              .collection("orders")
-              .document(active_order_id)
-        )
-        if not check_ref.get().exists:
-            need_new_order = True
-
-    # 3️⃣ สร้าง order ใหม่
-    if need_new_order:
-        timestamp_id = str(int(time.time() * 1000))
+    hint, _ = get_active_order_hint(shopname, customerName)
 
-        order_ref = (
-            customer_ref
-              .collection("orders")
-              .document(timestamp_id)
+    # get-or-create customer + draft order ใน transaction เดียว (ไม่อ่านซ้ำสิ่งที่เพิ่งเขียน)
+    docs = request_docs()
+    with docs.rpc(rpcs=0):
+        active_order_id, preorder = _get_preorder_txn(
+            db.transaction(), customer_ref, hint, docs
         )
 
-        order_ref.set({
-            "status": "draft",
-            "Preorder": 0,
-            "createdAt": datetime.utcnow()
-        })
-
-        customer_ref.update({
-            "activeOrderId": timestamp_id
-        })
-
-        active_order_id = timestamp_id
-
-    # 4️⃣ อ่าน Preorder
-    order_ref = (
-        customer_ref
-          .collection("orders")
-          .document(active_order_id)
-    )
-
-    order_doc = order_ref.get()
-    order_data = order_doc.to_dict() if order_doc.exists else {}
+    set_active_order(shopname, customerName, active_order_id)
 
     return jsonify({
         "status": "success",
-        "Preorder": order_data.get("Preorder", 0),
+        "Preorder": preorder,
         "orderId": active_order_id
     })
 
@@ -1255,6 +4220,7 @@ def get_preorder():
 from google.cloud import firestore
 
 @app.route("/inc_preorder", methods=["POST"])
+@idempotent
 def inc_preorder():
     data = request.get_json()
 
@@ -1274,7 +4240,13 @@ def inc_preorder():
           .document(customerName)
     )
 
-    customer_doc = customer_ref.get()
+    # activeOrderId ที่ cache จำไว้ → อ่าน customer + order ใน get_all ครั้งเดียว
+    docs = request_docs()
+    hint, _ = get_active_order_hint(shopname, customerName)
+    orders_ref = customer_ref.collection("orders")
+
+    refs = [customer_ref] + ([orders_ref.document(hint)] if hint else [])
+    customer_doc = docs.get_many(refs, ["activeOrderId", "status"])[0]
     if not customer_doc.exists:
         return jsonify({
             "status": "error",
@@ -1285,18 +4257,16 @@ def inc_preorder():
     active_order_id = customer_data.get("activeOrderId")
 
     if not active_order_id:
+        set_active_order(shopname, customerName, None)
         return jsonify({
             "status": "error",
             "message": "No active order"
         }), 400
 
-    order_ref = (
-        customer_ref
-          .collection("orders")
-          .document(active_order_id)
-    )
+    order_ref = orders_ref.document(active_order_id)
 
-    order_doc = order_ref.get()
+    # เดาผิด → อ่าน order จริงอีกครั้ง
+    order_doc = docs.get(order_ref, ["activeOrderId", "status"])
     if not order_doc.exists:
         return jsonify({
             "status": "error",
@@ -1313,9 +4283,11 @@ def inc_preorder():
         }), 400
 
     # ✅ เพิ่ม Preorder ทีละ 1
-    order_ref.update({
-        "Preorder": firestore.Increment(1)
-    })
+    with docs.rpc(writes=1):
+        order_ref.update({
+            "Preorder": firestore.Increment(1)
+        })
+    set_active_order(shopname, customerName, active_order_id)
 
     return jsonify({"status": "success"})
 
@@ -1393,7 +4365,17 @@ def get_customer():
               .document(customer_name)
         )
 
-        customer_doc = customer_ref.get()
+        # ใช้แค่ 3 field นี้ (ไม่ต้องส่ง passwordHash ฯลฯ กลับมาจาก Firestore)
+        # มี activeOrderId → อ่าน customer + order ใน get_all ครั้งเดียว
+        docs = request_docs()
+        order_ref = (
+            customer_ref.collection("orders").document(active_order_id)
+            if active_order_id else None
+        )
+        customer_doc, *order_docs = docs.get_many(
+            [customer_ref] + ([order_ref] if order_ref else []),
+            ["customerName", "phoneNumber", "address"]
+        )
         if not customer_doc.exists:
             return jsonify({
                 "status": "error",
@@ -1404,20 +4386,41 @@ def get_customer():
 
         items_list = []
 
+        # 📄 page_size / cursor (ใน JSON body) → อ่าน items ทีละหน้า
+        cursor = data.get("cursor")
+        next_cursor = None
+        try:
+            page_size = parse_page_size(data.get("page_size"))
+            # ✂️ fields (ใน JSON body) → select() เฉพาะ field ของ items
+            fields = parse_fields(data.get("fields"))
+        except ValueError as e:
+            return jsonify({
+                "status": "error",
+                "message": str(e)
+            }), 400
+
         # ===============================
         # 2️⃣ ถ้ามี activeOrderId → โหลด items
         # ===============================
         if active_order_id:
-            order_ref = (
-                customer_ref
-                  .collection("orders")
-                  .document(active_order_id)
-            )
-
-            order_doc = order_ref.get()
+            order_doc = order_docs[0]
             if order_doc.exists:
                 items_ref = order_ref.collection("items")
-                items_docs = items_ref.stream()
+
+                if page_size or cursor:
+                    try:
+                        items_docs, next_cursor = page_query(
+                            items_ref, cursor, page_size or PAGE_SIZE_MAX, fields
+                        )
+                    except ValueError as e:
+                        return jsonify({
+                            "status": "error",
+                            "message": str(e)
+                        }), 400
+                elif fields:
+                    items_docs = items_ref.select(fields).stream()
+                else:
+                    items_docs = items_ref.stream()
 
                 for item in items_docs:
                     item_data = item.to_dict()
@@ -1427,7 +4430,7 @@ def get_customer():
         # ===============================
         # 3️⃣ ส่งข้อมูลกลับ
         # ===============================
-        return jsonify({
+        response = {
             "status": "success",
             "customerName": customer.get("customerName", ""),
             "phoneNumber": customer.get("phoneNumber", ""),
@@ -1435,10 +4438,14 @@ def get_customer():
             "shopname": shopname,
             "activeOrderId": active_order_id,
             "items": items_list   # ✅ สำคัญมาก
-        }), 200
+        }
+        if page_size or cursor:
+            response["next_cursor"] = next_cursor
+
+        return jsonify(response), 200
 
     except Exception as e:
-        print("🔥 ERROR get_customer:", e)
+        log("🔥 ERROR get_customer:", e)
         return jsonify({
             "status": "error",
             "message": str(e)
@@ -1557,4 +4564,149 @@ def generate_qr():
         return jsonify({
             "status": "error",
             "message": str(e)
-        }), 500
\ No newline at end of file
+        }), 500
+
+
+# ---------------- Batch -------------------
+# เปิดหน้าจอหลักของ MAUI ต้องเรียกหลาย API (get_preorder, get_customer, get_modesonline, ...)
+# รวมเป็น POST /batch ครั้งเดียว → จ่าย TLS / round trip บน 3G ครั้งเดียว
+#
+# {"requests": [
+#     {"id": "preorder", "method": "GET", "path": "/get_preorder", "query": {"shopname": "...", "customerName": "..."}},
+#     {"id": "save", "method": "POST", "path": "/save_order", "body": {...}, "headers": {"Idempotency-Key": "..."}},
+#     {"id": "orders", "method": "GET", "path": "/get_orders?...", "depends_on": ["save"]}
+# ]}
+#
+# แต่ละรายการวิ่งผ่าน Flask เหมือน request จริง (before/after_request, metrics, idempotency)
+# ไม่มี depends_on → ทำพร้อมกันใน thread pool, มี depends_on → รอรอบก่อนหน้าเสร็จ
+BATCH_MAX_REQUESTS = int(os.environ.get("BATCH_MAX_REQUESTS", "20"))
+BATCH_THREADS = int(os.environ.get("BATCH_THREADS", "8"))
+# Idempotency-Key ของ /batch ไม่ส่งต่อ — ใส่ใน headers ของแต่ละรายการเอง
+BATCH_FORWARD_HEADERS = ("Accept-Language",)
+BATCH_RESPONSE_HEADERS = ("ETag", "Last-Modified", "Cache-Control", "Server-Timing", "Idempotent-Replayed")
+
+# endpoint ที่เรียกผ่าน batch ไม่ได้ (ซ้อน batch / stream ที่ไม่จบ)
+BATCH_EXCLUDED_ENDPOINTS = {"batch", "stream_notifications"}
+
+# แยก pool → sub-request ไปใช้ _bulk_executor / _order_executor / _catalog_executor ต่อได้โดยไม่ deadlock
+_batch_executor = ThreadPoolExecutor(
+    max_workers=BATCH_THREADS,
+    thread_name_prefix="batch"
+)
+
+
+def _batch_error(item_id, status, message):
+    return {"id": item_id, "status": status, "body": {"status": "error", "message": message}}
+
+
+def _batch_dispatch(item, base_headers):
+    parts = urllib.parse.urlsplit(item["path"])
+
+    try:
+        endpoint, _ = app.url_map.bind("localhost").match(parts.path, method=item["method"])
+    except HTTPException as e:
+        return _batch_error(item["id"], e.code, e.description)
+
+    if endpoint in BATCH_EXCLUDED_ENDPOINTS:
+        return _batch_error(item["id"], 400, f"{parts.path} cannot be batched")
+
+    query = parts.query
+    if isinstance(item["query"], dict):
+        extra = urllib.parse.urlencode(item["query"], doseq=True)
+        query = f"{query}&{extra}" if query else extra
+
+    headers = {**base_headers, **{str(k): str(v) for k, v in item["headers"].items()}}
+
+    # client แยกต่อรายการ → thread-safe, มี request context / g ของตัวเอง
+    with app.test_client() as client:
+        response = client.open(
+            parts.path,
+            method=item["method"],
+            query_string=query,
+            json=item["body"],
+            headers=headers
+        )
+
+    result = {"id": item["id"], "status": response.status_code}
+
+    response_headers = {
+        name: response.headers[name]
+        for name in BATCH_RESPONSE_HEADERS if name in response.headers
+    }
+    if response_headers:
+        result["headers"] = response_headers
+
+    if response.is_json:
+        result["body"] = response.get_json()
+    else:
+        # รูป / QR ฯลฯ
+        result["body"] = base64.b64encode(response.get_data()).decode("ascii")
+        result["encoding"] = "base64"
+        result["content_type"] = response.mimetype
+
+    return result
+
+
+@app.route("/batch", methods=["POST"])
+def batch():
+    try:
+        data = request.get_json(silent=True) or {}
+        items = data.get("requests")
+
+        if not isinstance(items, list) or not items:
+            return jsonify({"status": "error", "message": "Missing requests"}), 400
+
+        if len(items) > BATCH_MAX_REQUESTS:
+            return jsonify({
+                "status": "error",
+                "message": f"Too many requests (max {BATCH_MAX_REQUESTS})"
+            }), 400
+
+        try:
+            items, waves = plan_batch(items)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+
+        base_headers = {
+            name: request.headers[name]
+            for name in BATCH_FORWARD_HEADERS if name in request.headers
+        }
+
+        results = [None] * len(items)
+        failed = set()
+
+        for wave in waves:
+            futures = {}
+            for i in wave:
+                item = items[i]
+                blocked = [d for d in item["depends_on"] if d in failed]
+                if blocked:
+                    # รายการที่รออยู่ล้ม → ไม่ทำต่อ
+                    results[i] = _batch_error(
+                        item["id"], 424, f"Dependency failed: {', '.join(blocked)}"
+                    )
+                    failed.add(item["id"])
+                    continue
+                futures[i] = _batch_executor.submit(_batch_dispatch, item, base_headers)
+
+            for i, future in futures.items():
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    log("🔥 ERROR batch:", traceback.format_exc())
+                    results[i] = _batch_error(items[i]["id"], 500, str(e))
+
+                if results[i]["status"] >= 400:
+                    failed.add(items[i]["id"])
+
+        return jsonify({
+            "status": "success",
+            "responses": results
+        })
+
+    except Exception as e:
+        log("🔥 ERROR batch:", e)
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
@@ -0,0 +1,50 @@
+# ---------------- Batch planning -------------------
+# ตรวจรายการของ POST /batch แล้วแบ่งเป็นรอบตาม depends_on
+
+
+def plan_batch(items):
+    # คืน (รายการที่ normalize แล้ว, รอบที่ต้องทำ [[index, ...], ...]) หรือ raise ValueError
+    ids = {}
+    normalized = []
+
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not isinstance(item.get("path"), str):
+            raise ValueError(f"requests[{index}] needs a path")
+
+        item_id = str(item.get("id", index))
+        if item_id in ids:
+            raise ValueError(f"Duplicate request id {item_id}")
+        ids[item_id] = index
+
+        depends_on = item.get("depends_on") or []
+        if not isinstance(depends_on, list):
+            raise ValueError(f"requests[{index}].depends_on must be a list")
+
+        normalized.append({
+            "id": item_id,
+            "method": str(item.get("method", "GET")).upper(),
+            "path": item["path"],
+            "query": item.get("query"),
+            "body": item.get("body"),
+            "headers": item.get("headers") or {},
+            "depends_on": [str(d) for d in depends_on]
+        })
+
+    for item in normalized:
+        for dep in item["depends_on"]:
+            if dep not in ids:
+                raise ValueError(f"Unknown depends_on {dep} in {item['id']}")
+
+    # แบ่งเป็นรอบ (topological) — รายการในรอบเดียวกันไม่ขึ้นต่อกัน
+    waves = []
+    done = set()
+    remaining = list(range(len(normalized)))
+    while remaining:
+        wave = [i for i in remaining if all(d in done for d in normalized[i]["depends_on"])]
+        if not wave:
+            raise ValueError("depends_on has a cycle")
+        waves.append(wave)
+        done.update(normalized[i]["id"] for i in wave)
+        remaining = [i for i in remaining if i not in wave]
+
+    return normalized, waves
@@ -0,0 +1,85 @@
+"""เทียบ latency และขนาดไฟล์ของ /edit_image ระหว่าง engine=local (Pillow) กับ engine=ai (gpt-image-1)
+
+    python bench_edit_image.py photo1.jpg photo2.jpg
+    python bench_edit_image.py photo1.jpg --url http://localhost:8000 --ai-runs 1
+
+ไม่ใส่ --url → วัดเฉพาะ local ในเครื่อง (imageops โดยตรง)
+ใส่ --url → ยิง /edit_image ของ server จริงทั้งสอง engine
+(AI: ครั้งแรกของรูปเดิมคือ miss จริง, ครั้งต่อไปมาจาก edit cache)
+"""
+import argparse
+import statistics
+import time
+
+import imageops
+
+
+def summarize(name, latencies, in_size, out_size):
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(
+        f"{name:<14} runs={len(latencies):<3} "
+        f"median={statistics.median(latencies):8.1f} ms  "
+        f"p95={p95:8.1f} ms  "
+        f"in={in_size / 1024:8.1f} KB  out={out_size / 1024:8.1f} KB"
+    )
+
+
+def bench_local(image_bytes, runs, fmt):
+    latencies = []
+    out = b""
+    for _ in range(runs):
+        start = time.perf_counter()
+        out = imageops.white_canvas_edit(image_bytes, fmt=fmt)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies, len(out)
+
+
+def bench_http(url, image_bytes, runs, engine, fmt="png"):
+    import requests
+
+    session = requests.Session()
+    latencies = []
+    out = b""
+    for _ in range(runs):
+        start = time.perf_counter()
+        r = session.post(
+            f"{url}/edit_image",
+            files={"image": ("image.jpg", image_bytes, "image/jpeg")},
+            data={"engine": engine, "format": fmt},
+            timeout=300
+        )
+        latencies.append((time.perf_counter() - start) * 1000)
+        r.raise_for_status()
+        out = r.content
+    return latencies, len(out)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("images", nargs="+")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--url", help="base URL ของ server เช่น http://localhost:8000")
+    parser.add_argument("--ai-runs", type=int, default=1)
+    args = parser.parse_args()
+
+    for path in args.images:
+        with open(path, "rb") as f:
+            image_bytes = f.read()
+
+        print(f"== {path}")
+        for fmt in ("PNG", "JPEG"):
+            latencies, out_size = bench_local(image_bytes, args.runs, fmt)
+            summarize(f"local {fmt.lower()}", latencies, len(image_bytes), out_size)
+
+        if args.url:
+            latencies, out_size = bench_http(args.url, image_bytes, args.runs, "local")
+            summarize("http local", latencies, len(image_bytes), out_size)
+
+            if args.ai_runs > 0:
+                latencies, out_size = bench_http(args.url, image_bytes, args.ai_runs, "ai")
+                summarize("http ai", latencies, len(image_bytes), out_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import bisect
+import threading
+import time
+
+# ---------------- Bucket index (cache ของ list_blobs) -------------------
+# เก็บรายชื่อไฟล์ใต้ prefix ไว้ในหน่วยความจำ แยกตาม prefix
+# entry = {"names": [...], "folders": {folder: [rest, ...]}, "loaded_at": ...}
+# แต่ละ gunicorn worker มี index ของตัวเอง → TTL ช่วย sync กับ worker อื่น
+
+
+def _index_insert(entry, prefix, name):
+    # copy-on-write: request ที่กำลังอ่าน list/dict เดิมอยู่จะไม่เห็นการแก้กลางทาง
+    names = entry["names"]
+    i = bisect.bisect_left(names, name)
+    if i < len(names) and names[i] == name:
+        return
+    entry["names"] = names[:i] + [name] + names[i:]
+
+    rel = name[len(prefix):]
+    if "/" in rel:
+        folder, rest = rel.split("/", 1)
+        if folder:
+            folders = dict(entry["folders"])
+            files = list(folders.get(folder, []))
+            bisect.insort(files, rest)
+            folders[folder] = files
+            entry["folders"] = folders
+
+
+class BucketIndex:
+    def __init__(self, list_names, ttl):
+        # list_names(prefix) → ชื่อไฟล์ทั้งหมดใต้ prefix (เช่น list_blobs)
+        self.list_names = list_names
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        # list ที่กำลังทำอยู่ → {id(load): (prefix, [ชื่อที่ upload ระหว่าง list])}
+        # key เป็น id ไม่ใช่ค่า → load ของ prefix เดียวกันที่ซ้อนกันไม่ลบของกันและกัน
+        self._loads = {}
+
+    def get(self, prefix):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(prefix)
+            if entry and now - entry["loaded_at"] < self.ttl:
+                return entry
+
+            # upload ที่เกิดระหว่าง list อาจไม่อยู่ในผล list → จดไว้แล้วใส่เพิ่มตอนจบ
+            load = (prefix, [])
+            self._loads[id(load)] = load
+
+        # list นอก lock เพื่อไม่ให้ request อื่นรอ RPC
+        try:
+            names = sorted(self.list_names(prefix))
+        except Exception:
+            with self._lock:
+                del self._loads[id(load)]
+            raise
+
+        folders = {}
+        for name in names:
+            rel = name[len(prefix):]
+            if "/" in rel:
+                folder, rest = rel.split("/", 1)
+                if folder:
+                    folders.setdefault(folder, []).append(rest)
+
+        entry = {"names": names, "folders": folders, "loaded_at": now}
+
+        with self._lock:
+            del self._loads[id(load)]
+            for name in load[1]:
+                _index_insert(entry, prefix, name)
+            self._entries[prefix] = entry
+        return entry
+
+    def add(self, name):
+        # เรียกหลัง upload → เพิ่มชื่อไฟล์เข้า index ที่ครอบคลุมอยู่ (ไม่ต้อง list ใหม่)
+        with self._lock:
+            for prefix, entry in self._entries.items():
+                if name.startswith(prefix):
+                    _index_insert(entry, prefix, name)
+
+            for prefix, added in self._loads.values():
+                if name.startswith(prefix):
+                    added.append(name)
@@ -0,0 +1,78 @@
+from io import BytesIO
+
+from PIL import Image, ImageFilter, ImageOps
+
+# ------------------- Local image edit (Pillow) -------------------
+# ทำงานแบบเดียวกับ prompt ของ gpt-image-1 ใน /edit_image แต่ทำในเครื่อง:
+# ขยาย canvas เป็นสี่เหลี่ยมพื้นขาว, ปรับแสง (autocontrast), เพิ่มความคม (unsharp mask)
+# แยกเป็น module เบาๆ เพื่อให้ process pool import ได้โดยไม่ต้องโหลด app.py (Firebase/OpenAI)
+
+CANVAS_SIZE = 1024
+BACKGROUND = (255, 255, 255)
+
+
+def _to_rgb(img):
+    # รูปโปร่งใส → วางบนพื้นขาว
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        flat = Image.new("RGB", img.size, BACKGROUND)
+        flat.paste(img, mask=img.getchannel("A"))
+        return flat
+    return img.convert("RGB")
+
+
+def white_canvas_edit(image_bytes, size=CANVAS_SIZE, fmt="PNG"):
+    img = Image.open(BytesIO(image_bytes))
+
+    # thumbnail = JPEG draft (decode แบบย่อ) + reducing_gap → เร็วกว่า decode เต็มแล้วย่อมาก
+    img.thumbnail((size, size), Image.BICUBIC, reducing_gap=2.0)
+    img = ImageOps.exif_transpose(img)
+    img = _to_rgb(img)
+
+    # รูปเล็กกว่า canvas → ขยายให้เต็มด้านยาว
+    if img.width < size and img.height < size:
+        img = ImageOps.contain(img, (size, size), Image.LANCZOS)
+
+    img = ImageOps.autocontrast(img, cutoff=1)
+    img = img.filter(ImageFilter.UnsharpMask(radius=2, percent=120, threshold=3))
+
+    canvas = Image.new("RGB", (size, size), BACKGROUND)
+    canvas.paste(img, ((size - img.width) // 2, (size - img.height) // 2))
+
+    out = BytesIO()
+    if fmt == "JPEG":
+        canvas.save(out, format="JPEG", quality=90)
+    else:
+        # compress_level ต่ำ → encode เร็ว (ไฟล์ใหญ่ขึ้นเล็กน้อย)
+        canvas.save(out, format="PNG", compress_level=1)
+    return out.getvalue()
+
+
+# ------------------- Upload variants -------------------
+# decode รูปต้นฉบับครั้งเดียว แล้วย่อเป็นหลายขนาด (ใหญ่ → เล็ก)
+# sizes = {"detail": 1280, "list": 640, "thumb": 256} → คืน {"detail": bytes, ...}
+
+VARIANT_QUALITY = 80
+
+
+def make_variants(image_bytes, sizes, fmt="WEBP"):
+    img = Image.open(BytesIO(image_bytes))
+
+    largest = max(sizes.values())
+    img.thumbnail((largest, largest), Image.BICUBIC, reducing_gap=2.0)
+    img = ImageOps.exif_transpose(img)
+    img = _to_rgb(img)
+
+    variants = {}
+    for name, max_side in sorted(sizes.items(), key=lambda kv: -kv[1]):
+        # ย่อจากขนาดก่อนหน้า (เล็กลงเรื่อยๆ) ไม่ขยายรูปเล็ก
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        out = BytesIO()
+        if fmt == "JPEG":
+            img.save(out, format="JPEG", quality=VARIANT_QUALITY, optimize=True, progressive=True)
+        else:
+            img.save(out, format="WEBP", quality=VARIANT_QUALITY, method=4)
+        variants[name] = out.getvalue()
+
+    return variants
@@ -0,0 +1,67 @@
+import base64
+import json
+
+# ---------------- Cursor pagination -------------------
+# ?page_size=20&cursor=... → อ่านทีละหน้าด้วย start_after
+# cursor = base64url ของ JSON ค่าที่ใช้ order_by ของเอกสารสุดท้ายในหน้า (client ไม่ต้องแกะ)
+# แยกเป็น module (ไม่พึ่ง Firebase / Flask) → test ได้โดยไม่ต้อง import app.py
+PAGE_SIZE_MAX = 500
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, length):
+    # cursor เสีย → ValueError (route ตอบ 400)
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def parse_page_size(value, default=None):
+    # ไม่ส่ง page_size → default (None = ไม่แบ่งหน้า แบบเดิม)
+    if value is None or value == "":
+        return default
+    try:
+        page_size = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid page_size")
+    if page_size <= 0:
+        raise ValueError("Invalid page_size")
+    return min(page_size, PAGE_SIZE_MAX)
+
+
+def parse_fields(value, allowed=None):
+    # ?fields=productname,pricesingle → ("productname", "pricesingle") หรือ None (ทุก field)
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = value.split(",")
+
+    fields = tuple(dict.fromkeys(str(f).strip() for f in value if str(f).strip()))
+    for field in fields:
+        if (allowed is not None and field not in allowed) or "`" in field:
+            raise ValueError(f"Invalid field: {field}")
+    return fields or None
+
+
+def page_query(collection_ref, cursor, page_size, fields=None):
+    # เรียงตาม document id; คืน (docs, next_cursor)
+    query = collection_ref.order_by("__name__")
+    if fields:
+        query = query.select(fields)
+    if cursor:
+        (last_id,) = decode_cursor(cursor, 1)
+        query = query.start_after([collection_ref.document(last_id)])
+
+    docs = list(query.limit(page_size).stream())
+    next_cursor = encode_cursor([docs[-1].id]) if len(docs) == page_size else None
+    return docs, next_cursor
@@ -0,0 +1,170 @@
+import threading
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import batching
+import bucketindex
+import imageops
+import pagination
+
+
+def _image_bytes(size, color, fmt="PNG", mode="RGB", exif=None):
+    img = Image.new(mode, size, color)
+    out = BytesIO()
+    if exif is not None:
+        img.save(out, format=fmt, exif=exif)
+    else:
+        img.save(out, format=fmt)
+    return out.getvalue()
+
+
+# ------------------- imageops -------------------
+
+def test_white_canvas_edit_is_square_canvas():
+    src = _image_bytes((400, 200), (200, 30, 30))
+    out = Image.open(BytesIO(imageops.white_canvas_edit(src, size=256)))
+
+    assert out.format == "PNG"
+    assert out.size == (256, 256)
+    # รูปกว้างกว่าสูง → ขอบบน/ล่างเป็นพื้นขาว
+    assert out.getpixel((128, 2)) == imageops.BACKGROUND
+    assert out.getpixel((128, 253)) == imageops.BACKGROUND
+    assert out.getpixel((128, 128)) != imageops.BACKGROUND
+
+
+def test_white_canvas_edit_flattens_transparency_on_white():
+    src = _image_bytes((64, 64), (0, 0, 0, 0), mode="RGBA")
+    out = Image.open(BytesIO(imageops.white_canvas_edit(src, size=128, fmt="JPEG")))
+
+    assert out.format == "JPEG"
+    assert out.size == (128, 128)
+    assert all(c > 245 for c in out.getpixel((64, 64)))
+
+
+def test_make_variants_sizes():
+    variants = imageops.make_variants(
+        _image_bytes((2000, 1000), (10, 120, 200), fmt="JPEG"),
+        {"detail": 1280, "list": 640, "thumb": 256}
+    )
+
+    sizes = {name: Image.open(BytesIO(data)).size for name, data in variants.items()}
+    assert sizes == {"detail": (1280, 640), "list": (640, 320), "thumb": (256, 128)}
+
+
+def test_make_variants_applies_exif_rotation():
+    exif = Image.Exif()
+    exif[0x0112] = 6   # Orientation: หมุน 90° ตามเข็ม
+    src = _image_bytes((300, 100), (10, 120, 200), fmt="JPEG", exif=exif)
+
+    variants = imageops.make_variants(src, {"thumb": 256}, fmt="JPEG")
+
+    assert Image.open(BytesIO(variants["thumb"])).size == (85, 256)
+
+
+# ------------------- pagination -------------------
+
+def test_cursor_round_trip():
+    values = ["2026-01-02T03:04:05+00:00", "สินค้า/ขายดี"]
+    cursor = pagination.encode_cursor(values)
+
+    assert "=" not in cursor
+    assert pagination.decode_cursor(cursor, 2) == values
+
+
+@pytest.mark.parametrize("cursor, length", [
+    ("not base64 !!", 1),
+    (pagination.encode_cursor({"id": "x"}), 1),      # ไม่ใช่ list
+    (pagination.encode_cursor(["a", "b"]), 1),       # ความยาวไม่ตรง
+    ("", 1),
+])
+def test_decode_cursor_rejects_bad_cursors(cursor, length):
+    with pytest.raises(ValueError):
+        pagination.decode_cursor(cursor, length)
+
+
+def test_parse_page_size():
+    assert pagination.parse_page_size(None) is None
+    assert pagination.parse_page_size("", 50) == 50
+    assert pagination.parse_page_size("20") == 20
+    assert pagination.parse_page_size("100000") == pagination.PAGE_SIZE_MAX
+    for bad in ("0", "-1", "abc"):
+        with pytest.raises(ValueError):
+            pagination.parse_page_size(bad)
+
+
+# ------------------- batch planning -------------------
+
+def test_plan_batch_waves():
+    items, waves = batching.plan_batch([
+        {"id": "preorder", "path": "/get_preorder"},
+        {"id": "save", "method": "post", "path": "/save_order", "body": {}},
+        {"id": "orders", "path": "/get_orders", "depends_on": ["save"]},
+        {"id": "customer", "path": "/get_customer", "depends_on": ["orders", "preorder"]},
+        {"path": "/get_modesonline"},
+    ])
+
+    assert waves == [[0, 1, 4], [2], [3]]
+    assert items[1]["method"] == "POST"
+    assert items[4]["id"] == "4"
+
+
+@pytest.mark.parametrize("requests", [
+    [{"id": "a", "path": "/x", "depends_on": ["b"]}, {"id": "b", "path": "/y", "depends_on": ["a"]}],
+    [{"id": "a", "path": "/x", "depends_on": ["a"]}],
+    [{"id": "a", "path": "/x", "depends_on": ["missing"]}],
+    [{"id": "a", "path": "/x"}, {"id": "a", "path": "/y"}],
+    [{"id": "a"}],
+    [{"id": "a", "path": "/x", "depends_on": "b"}],
+])
+def test_plan_batch_rejects_invalid(requests):
+    with pytest.raises(ValueError):
+        batching.plan_batch(requests)
+
+
+# ------------------- bucket index -------------------
+
+def test_bucket_index_add_updates_loaded_prefix():
+    index = bucketindex.BucketIndex(lambda prefix: [prefix + "b/1.jpg"], ttl=60)
+    index.get("shop/")
+
+    index.add("shop/a/2.jpg")
+    index.add("other/x.jpg")
+
+    entry = index.get("shop/")
+    assert entry["names"] == ["shop/a/2.jpg", "shop/b/1.jpg"]
+    assert entry["folders"] == {"a": ["2.jpg"], "b": ["1.jpg"]}
+
+
+def test_bucket_index_keeps_uploads_from_overlapping_loads():
+    # load ของ prefix เดียวกันซ้อนกัน: ตัวที่เริ่มทีหลังจบก่อน ต้องไม่ลบ load ของตัวแรก
+    first_listing = threading.Event()
+    release_first = threading.Event()
+
+    def list_names(prefix):
+        if not first_listing.is_set():
+            first_listing.set()
+            release_first.wait(5)
+        return []
+
+    index = bucketindex.BucketIndex(list_names, ttl=0)
+    results = {}
+
+    def first_load():
+        try:
+            results["first"] = index.get("shop/")
+        except Exception as e:
+            results["error"] = e
+
+    first = threading.Thread(target=first_load)
+    first.start()
+    assert first_listing.wait(5)
+
+    index.get("shop/")
+    index.add("shop/new.jpg")
+    release_first.set()
+    first.join(5)
+
+    assert "error" not in results
+    assert results["first"]["names"] == ["shop/new.jpg"]